@@ -0,0 +1,56 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.interim_to_processed import assign_new_image_names, old_image_file_keys
+
+
+def make_interim(n_rows: int, n_folders: int = 100, seed: int = 0) -> tuple[pd.DataFrame, dict]:
+    """Synthetic interim data, with the same image name reused across folders, and its new image name mapping."""
+    rng = np.random.default_rng(seed)
+    folders = np.array([f"/data/01-raw/source-{i}" for i in range(n_folders)], dtype=object)
+    names = np.array([f"frame_{i:07d}.jpg" for i in range(n_rows // n_folders + 1)], dtype=object)
+
+    df = pd.DataFrame(
+        {
+            "old_image_path": folders[rng.integers(0, n_folders, n_rows)],
+            "old_image_name": names[rng.integers(0, len(names), n_rows)],
+        }
+    )
+    files = old_image_file_keys(df, "old_image_path", "old_image_name").unique()
+    new_image_names = {file: f"{i:032x}.jpg" for i, file in enumerate(files)}
+
+    return df, new_image_names
+
+
+def bench(n_rows: int) -> float:
+    df, new_image_names = make_interim(n_rows)
+
+    start = time.perf_counter()
+    old_image_files = old_image_file_keys(df, "old_image_path", "old_image_name")
+    assign_new_image_names(df, old_image_files, new_image_names)
+    elapsed = time.perf_counter() - start
+
+    assert df["new_image_name"].notna().all()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark new_image_name assignment of interim_to_processed.")
+    parser.add_argument(
+        "-n",
+        "--rows",
+        type=int,
+        nargs="+",
+        help="Number of rows to benchmark. (default: %(default)s)",
+        default=[10_000, 100_000, 1_000_000],
+    )
+
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'seconds':>10} {'us/row':>10}")
+    for n_rows in args.rows:
+        elapsed = bench(n_rows)
+        print(f"{n_rows:>10} {elapsed:>10.3f} {elapsed / n_rows * 1e6:>10.3f}")
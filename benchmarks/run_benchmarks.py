@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import colorama
+import numpy as np
+from colorama import Fore
+from synthetic import make_dataset
+
+from src.combine_csv import KeepMode, combine_csv
+from src.interim_to_processed import interim_to_processed
+from src.utils import cxywh2xyxy_batch, generate_md5_file, instrument, load_yaml_file
+from src.yolo_to_csv import yolo_to_csv
+
+colorama.init()
+
+BASELINE_FILE = Path(__file__).with_name("baseline.json")
+CONFIG_FILE = "config/config.yaml"
+
+# Hash every image, as on a first run, and keep the synthetic images out of the user hash cache
+os.environ["MD5_CACHE_FILE"] = ""
+
+
+def _files(folder: Path, pattern: str) -> list:
+    return sorted(folder.glob(pattern))
+
+
+def _size(files) -> int:
+    return sum(os.path.getsize(file) for file in files)
+
+
+def bench_yolo_to_csv(data: Path, scratch: Path) -> tuple:
+    header = load_yaml_file(CONFIG_FILE)["yolo_to_csv_header"]
+    output_file = scratch / "interim_data.csv"
+    yolo_to_csv(data / "01-raw", output_file, csv_header=header)
+
+    with open(output_file) as f:
+        rows = sum(1 for _ in f) - 1
+
+    return rows, _size(_files(data / "01-raw", "**/*.txt"))
+
+
+def bench_interim_to_processed(data: Path, scratch: Path) -> tuple:
+    rows = 0
+    for interim_file in _files(data / "02-interim", "*/interim_data.csv"):
+        with open(interim_file) as f:
+            rows += sum(1 for _ in f) - 1
+        interim_to_processed(interim_file, scratch / interim_file.parent.name, CONFIG_FILE)
+
+    return rows, _size(_files(data / "01-raw", "**/*.jpg"))
+
+
+def bench_combine_csv(data: Path, scratch: Path) -> tuple:
+    csv_files = _files(data / "03-processed", "*/processed_data.csv")
+    combine_csv(csv_files, scratch / "processed_data.csv", filter=True, keep=KeepMode.best)
+
+    rows = 0
+    for csv_file in csv_files:
+        with open(csv_file) as f:
+            rows += sum(1 for _ in f) - 1
+
+    return rows, _size(csv_files)
+
+
+def bench_generate_md5_file(data: Path, scratch: Path) -> tuple:
+    images = _files(data / "01-raw", "**/*.jpg")
+    for image in images:
+        generate_md5_file(image, use_cache=False)
+
+    return len(images), _size(images)
+
+
+def bench_cxywh2xyxy_batch(data: Path, scratch: Path) -> tuple:
+    boxes = np.random.default_rng(0).random((1_000_000, 4))
+    cxywh2xyxy_batch(boxes, img_size=(1920, 1080))
+
+    return len(boxes), boxes.nbytes
+
+
+STAGES = {
+    "yolo_to_csv": bench_yolo_to_csv,
+    "interim_to_processed": bench_interim_to_processed,
+    "combine_csv": bench_combine_csv,
+    "generate_md5_file": bench_generate_md5_file,
+    "cxywh2xyxy_batch": bench_cxywh2xyxy_batch,
+}
+
+
+def _run_stage(name: str, data: Path, scratch: Path) -> dict:
+    """Run one stage in the current, fresh, process and measure it."""
+    instrument.RUN = instrument.Run(name, progress=False)
+    start = time.perf_counter()
+    rows, nbytes = STAGES[name](data, scratch)
+    seconds = time.perf_counter() - start
+
+    return {
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_s": rows / seconds,
+        "mb_per_s": nbytes / seconds / 2**20,
+        "peak_rss_mb": instrument.peak_rss_mb(),
+    }
+
+
+def run_stage(name: str, data: Path, repeat: int = 3) -> dict:
+    """Best time of repeat runs of a stage, each in a new process with an empty scratch folder, and its peak RSS."""
+    results = []
+
+    for _ in range(repeat):
+        with (
+            tempfile.TemporaryDirectory() as scratch,
+            ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor,
+        ):
+            results.append(executor.submit(_run_stage, name, data, Path(scratch)).result())
+
+    best = min(results, key=lambda result: result["seconds"])
+    best["peak_rss_mb"] = max(result["peak_rss_mb"] for result in results)
+    return best
+
+
+def prepare_data(data: Path, params: dict):
+    """Generate the synthetic dataset once, and the processed data used by combine_csv."""
+    if (data / "params.json").exists():
+        with open(data / "params.json") as f:
+            if json.load(f) == params:
+                return
+
+    shutil.rmtree(data, ignore_errors=True)
+    print(Fore.BLUE + f"Generating synthetic dataset in {data}")
+    make_dataset(data, CONFIG_FILE, params["sources"], params["images"], params["boxes"], tuple(params["image_size"]))
+    for interim_file in _files(data / "02-interim", "*/interim_data.csv"):
+        interim_to_processed(interim_file, data / "03-processed" / interim_file.parent.name, CONFIG_FILE)
+
+    with open(data / "params.json", "w") as f:
+        json.dump(params, f)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Print every stage against the baseline, return the regressed stages."""
+    regressions = []
+    print(f"{'stage':<22} {'rows/s':>12} {'MB/s':>9} {'peak MB':>9} {'vs baseline':>12}")
+
+    for name, result in results.items():
+        base = baseline.get("stages", {}).get(name)
+        line = f"{name:<22} {result['rows_per_s']:>12.0f} {result['mb_per_s']:>9.1f} {result['peak_rss_mb']:>9.0f}"
+
+        if base is None:
+            print(line + f"{'-':>13}")
+            continue
+
+        speed = result["rows_per_s"] / base["rows_per_s"] - 1
+        memory = result["peak_rss_mb"] / base["peak_rss_mb"] - 1
+        is_regression = speed < -threshold or memory > threshold
+        color = Fore.RED if is_regression else Fore.GREEN
+        print(color + line + f" {speed:>+11.0%}" + (f" RSS {memory:+.0%}" if memory > threshold else "") + Fore.RESET)
+
+        if is_regression:
+            regressions.append(name)
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on a synthetic dataset.")
+    parser.add_argument("-s", "--stages", nargs="+", help="Stages to run, default to all", choices=list(STAGES))
+    parser.add_argument("--sources", type=int, help="Number of data sources. (default: %(default)s)", default=2)
+    parser.add_argument("--images", type=int, help="Number of images per source. (default: %(default)s)", default=500)
+    parser.add_argument("--boxes", type=int, help="Number of boxes per image. (default: %(default)s)", default=2)
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        nargs=2,
+        metavar=("WIDTH", "HEIGHT"),
+        help="Image size. (default: %(default)s)",
+        default=[640, 480],
+    )
+    parser.add_argument(
+        "--repeat", type=int, help="Runs per stage, the best is kept. (default: %(default)s)", default=3
+    )
+    parser.add_argument(
+        "--data_folder",
+        type=str,
+        help="Folder of the synthetic dataset, reused while the parameters are the same. (default: %(default)s)",
+        default=os.path.join(tempfile.gettempdir(), "dataset-template-bench"),
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="Baseline results file. (default: benchmarks/baseline.json)",
+        default=str(BASELINE_FILE),
+    )
+    parser.add_argument("--save_baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Slowdown or memory growth reported as regression. (default: %(default)s)",
+        default=0.2,
+    )
+    parser.add_argument("-o", "--output_file", type=str, help="Save the results to a json file")
+
+    args = parser.parse_args()
+
+    params = {"sources": args.sources, "images": args.images, "boxes": args.boxes, "image_size": args.image_size}
+    data = Path(args.data_folder)
+    prepare_data(data, params)
+
+    results = {name: run_stage(name, data, args.repeat) for name in args.stages or STAGES}
+    report = {"params": params, "python": platform.python_version(), "machine": platform.machine(), "stages": results}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline.get("params") != params:
+            print(Fore.YELLOW + f"Baseline {args.baseline} was run with {baseline.get('params')}, not compared")
+            baseline = {}
+
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        if baseline.get("stages"):
+            report["stages"] = {**baseline["stages"], **results}
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved as {args.baseline}")
+    elif regressions:
+        print(Fore.RED + f"Regression in {', '.join(regressions)}")
+        sys.exit(1)
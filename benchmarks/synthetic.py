@@ -0,0 +1,139 @@
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from src.utils import load_yaml_file
+from src.yolo_to_csv import yolo_to_csv
+
+
+def make_raw(
+    folder: str,
+    n_images: int,
+    boxes_per_image: int = 2,
+    image_size: tuple = (640, 480),
+    seed: int = 0,
+):
+    """Synthetic YOLO dataset: n_images JPEG images, with one label file of boxes_per_image boxes each.
+
+    Labels are in the named format of this repo, image name, cx, cy, w, h in pixels, license plate. The images are smooth
+    gradients with noise, so they compress like photos rather than flat colors.
+
+    Args:
+        folder (str): output folder, created if missing
+        n_images (int): number of images and label files
+        boxes_per_image (int, optional): number of boxes per label file. Defaults to 2.
+        image_size (tuple, optional): (width, height) of the images. Defaults to (640, 480).
+        seed (int, optional): random seed. Defaults to 0.
+    """
+    rng = np.random.default_rng(seed)
+    folder = Path(folder)
+    os.makedirs(folder, exist_ok=True)
+
+    width, height = image_size
+    gradient = np.add.outer(np.arange(height), np.arange(width)) % 256
+
+    for i in range(n_images):
+        noise = rng.integers(0, 32, (height, width, 3))
+        pixels = (gradient[..., None] + rng.integers(0, 256, 3) + noise) % 256
+        Image.fromarray(pixels.astype(np.uint8)).save(folder / f"frame_{i:07d}.jpg", quality=85)
+
+        # Pixel boxes, centered in the middle 60% of the image and at most 20% of its size, so they fit inside it
+        center = np.rint(rng.uniform(0.2, 0.8, (boxes_per_image, 2)) * image_size).astype(int)
+        size = np.rint(rng.uniform(0.05, 0.2, (boxes_per_image, 2)) * image_size).astype(int)
+        plates = [f"W{chr(65 + j % 26)}{rng.integers(1, 9999)}" for j in range(boxes_per_image)]
+
+        with open(folder / f"frame_{i:07d}.txt", "w") as f:
+            for (cx, cy), (w, h), lp in zip(center, size, plates):
+                f.write(f"frame_{i:07d}.jpg {cx} {cy} {w} {h} {lp}\n")
+
+
+def make_interim(raw_folder: str, interim_file: str, config: dict, seed: int = 0) -> pd.DataFrame:
+    """Interim csv of a synthetic raw folder, with random annotations from the config values.
+
+    Args:
+        raw_folder (str): folder made by make_raw
+        interim_file (str): output interim csv
+        config (dict): loaded config
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: interim data
+    """
+    rng = np.random.default_rng(seed)
+    yolo_to_csv(raw_folder, interim_file, csv_header=config["yolo_to_csv_header"])
+
+    df = pd.read_csv(interim_file)
+    for column, key in (
+        ("make", "vehicle_makes"),
+        ("type", "vehicle_types"),
+        ("colour", "vehicle_colors"),
+        ("environment", "environment"),
+    ):
+        df[column] = rng.choice(config[key], len(df))
+    df["isBack"] = rng.random(len(df)) < 0.3
+    df["processed"] = True
+
+    df.to_csv(interim_file, index=False)
+    return df
+
+
+def make_dataset(
+    root: str,
+    config_file: str,
+    n_sources: int = 2,
+    n_images: int = 500,
+    boxes_per_image: int = 2,
+    image_size: tuple = (640, 480),
+    seed: int = 0,
+):
+    """Synthetic data folder with data sources in 01-raw and their annotated interim csv in 02-interim.
+
+    Args:
+        root (str): data folder, containing 01-raw and 02-interim
+        config_file (str): path to config file
+        n_sources (int, optional): number of data sources. Defaults to 2.
+        n_images (int, optional): number of images per source. Defaults to 500.
+        boxes_per_image (int, optional): number of boxes per image. Defaults to 2.
+        image_size (tuple, optional): (width, height) of the images. Defaults to (640, 480).
+        seed (int, optional): random seed. Defaults to 0.
+    """
+    root = Path(root)
+    config = load_yaml_file(config_file)
+
+    for source in range(n_sources):
+        raw_folder = root / "01-raw" / f"source-{source}"
+        interim_folder = root / "02-interim" / f"source-{source}"
+        os.makedirs(interim_folder, exist_ok=True)
+
+        make_raw(raw_folder, n_images, boxes_per_image, image_size, seed + source)
+        make_interim(raw_folder, interim_folder / "interim_data.csv", config, seed + source)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic dataset, raw YOLO labels and images, and interim csv."
+    )
+    parser.add_argument("-o", "--output_folder", type=str, help="Output data folder", required=True)
+    parser.add_argument("-c", "--config", type=str, help="Config file path", default="config/config.yaml")
+    parser.add_argument("--sources", type=int, help="Number of data sources. (default: %(default)s)", default=2)
+    parser.add_argument("--images", type=int, help="Number of images per source. (default: %(default)s)", default=500)
+    parser.add_argument("--boxes", type=int, help="Number of boxes per image. (default: %(default)s)", default=2)
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        nargs=2,
+        metavar=("WIDTH", "HEIGHT"),
+        help="Image size. (default: %(default)s)",
+        default=[640, 480],
+    )
+    parser.add_argument("--seed", type=int, help="Random seed. (default: %(default)s)", default=0)
+
+    args = parser.parse_args()
+
+    make_dataset(
+        args.output_folder, args.config, args.sources, args.images, args.boxes, tuple(args.image_size), args.seed
+    )
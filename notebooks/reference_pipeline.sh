@@ -2,6 +2,9 @@
 # Reference pipeline - CLI way
 ###############################
 
+# Steps 1, 3 and 4 for every data source in data/01-raw, skipping unchanged stages:
+# python3 src/pipeline.py -c config/config.yaml -m xywh
+
 # Step 1: Convert yolo (txt) dataset to csv
 python3 src/yolo_to_csv.py -i data/1-raw/ -o data/2-interim/interim_data.csv -m xywh -c config/config.yaml
 
@@ -13,5 +16,5 @@ python3 src/annotate_image.py data/2-interim/interim_data.csv -c config/config.y
 python3 src/interim_to_processed.py data/2-interim/interim_data.csv -o data/3-processed/images -c config/config.yaml
 
 # Step 4: Combine all processed data
-python3 src/combine_csv.py data/3-processed/ -o data/4-combined/processed_data.csv
+python3 src/combine_csv.py data/3-processed/ -o data/4-combined/processed_data.csv -c config/config.yaml
 bash src/copy_images.sh data/3-processed/ data/4-combined/images
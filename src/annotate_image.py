@@ -1,52 +1,83 @@
 import argparse
 import os
 from pathlib import Path
-from tkinter import BooleanVar, StringVar, Tk, messagebox, simpledialog
-from tkinter.ttk import Button, Entry, Label
 
 import colorama
-import numpy as np
-import pandas as pd
-import yaml
 from colorama import Fore
-from PIL import Image, ImageDraw, ImageTk
-from ttkwidgets.autocomplete import AutocompleteCombobox
+
+from src.utils import instrument, lazy_import, load_yaml_file
+from src.utils.annotation_data import read_annotation_csv, write_sidecar
+from src.utils.edit_log import EditLog
+from src.utils.image_cache import ImagePrefetcher
+from src.utils.position_set import PositionSet
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+ImageTk = lazy_import("PIL.ImageTk")
+tk = lazy_import("tkinter")
+ttk = lazy_import("tkinter.ttk")
+messagebox = lazy_import("tkinter.messagebox")
+simpledialog = lazy_import("tkinter.simpledialog")
+autocomplete = lazy_import("ttkwidgets.autocomplete")
 
 colorama.init()
 
 
 class ImageAnnotatorApp:
-    def __init__(self, csv_file, config_file: str = "config.yml"):
+    def __init__(
+        self,
+        csv_file,
+        config_file: str = "config.yml",
+        prefetch: int = 4,
+        cache_mb: int = 256,
+        compact_every: int = 1000,
+        filters: dict = None,
+        thumbnail_cache: str = None,
+    ):
         self.csv_file = csv_file
-        self.data = pd.read_csv(csv_file)
-
-        if "processed" not in self.data.columns:
-            self.data["processed"] = False
-
-        self.index = -1
 
         # Load Config
         self.config = {}
 
         if config_file is not None:
-            with open(config_file, "r") as file:
-                self.config = yaml.safe_load(file)
+            self.config = load_yaml_file(config_file)
+
+        with instrument.stage("load"):
+            self.data = read_annotation_csv(csv_file, self.config)
+            instrument.count(rows=len(self.data))
+
+            # Edits are appended to a journal, and written back to the csv every compact_every edits and on quit.
+            # Deleted rows stay in self.data until then, so row position and index label are the same
+            self.edit_log = EditLog(csv_file, compact_every=compact_every)
+            if self.edit_log.replay(self.data):
+                self.edit_log.compact(self.data)
+                write_sidecar(csv_file, self.data)
+
+        self.index = -1
+
+        # Only rows matching all filters are navigated, e.g. {"environment": "night"}, "" matches missing value
+        self.filters = filters or {}
+        self.__build_index()
+
+        # Images of the next and previous rows are prepared in background
+        self.prefetch = prefetch
+        self.prefetcher = ImagePrefetcher(max_bytes=cache_mb * 1024 * 1024, cache_dir=thumbnail_cache)
 
         # Initialize UI component
-        self.root = Tk()
+        self.root = tk.Tk()
         self.root.title("Image Annotator")
-        self.image_label = Label(self.root)
-        self.lp_image_label = Label(self.root)
-        self.resampled_lp_image_label = Label(self.root)
-        self.status_label = Label(self.root, text="Status", justify="center")
+        self.image_label = ttk.Label(self.root)
+        self.lp_image_label = ttk.Label(self.root)
+        self.resampled_lp_image_label = ttk.Label(self.root)
+        self.status_label = ttk.Label(self.root, text="Status", justify="center")
 
         # Initialize tkinter variables
-        self.lp_var = StringVar()
-        self.make_var = StringVar()
-        self.type_var = StringVar()
-        self.colour_var = StringVar()
-        self.isback_var = BooleanVar()
-        self.env_var = StringVar()
+        self.lp_var = tk.StringVar()
+        self.make_var = tk.StringVar()
+        self.type_var = tk.StringVar()
+        self.colour_var = tk.StringVar()
+        self.isback_var = tk.BooleanVar()
+        self.env_var = tk.StringVar()
 
         # Option
         self.vehicle_makes = self.config["vehicle_makes"]
@@ -63,6 +94,12 @@ class ImageAnnotatorApp:
         # Start from the first unprocessed image
         self.__start_from_first_unprocessed()
         self.root.mainloop()
+        self.prefetcher.shutdown()
+
+        # Write all edits back to the csv
+        if self.edit_log.pending:
+            self.__compact()
+        self.edit_log.close()
 
     def __setup_ui(self):
         # Image display area
@@ -82,11 +119,11 @@ class ImageAnnotatorApp:
         self.__create_combobox("environment:", self.env_var, self.environment, self.environment[0])
 
         # Control buttons
-        Button(self.root, text="Update", command=self.__update_entry).grid(column=0, columnspan=2, pady=10)
+        ttk.Button(self.root, text="Update", command=self.__update_entry).grid(column=0, columnspan=2, pady=10)
         self.root.call(
             "grid",
-            Button(self.root, text="Previous", command=self.__load_previous_image),
-            Button(self.root, text="Next", command=self.__load_next_image),
+            ttk.Button(self.root, text="Previous", command=self.__load_previous_image),
+            ttk.Button(self.root, text="Next", command=self.__load_next_image),
             "-padx",
             "10",
             "-pady",
@@ -94,8 +131,8 @@ class ImageAnnotatorApp:
         )
         self.root.call(
             "grid",
-            Button(self.root, text="Go to Row N", command=self.__go_to_row_n),
-            Button(
+            ttk.Button(self.root, text="Go to Row N", command=self.__go_to_row_n),
+            ttk.Button(
                 self.root,
                 text="Go to First Unprocessed",
                 command=self.__start_from_first_unprocessed,
@@ -120,6 +157,7 @@ class ImageAnnotatorApp:
 
         # Big Jump Navigation
         self.root.bind("<Control-f>", lambda event: self.__go_to_row_n())
+        self.root.bind("<Control-n>", lambda event: self.__go_to_next_unprocessed())
         self.root.bind("<Control-r>", lambda event: self.__start_from_first_unprocessed())
         self.root.bind("<Home>", lambda event: self.__start_from_first_unprocessed())
 
@@ -131,8 +169,8 @@ class ImageAnnotatorApp:
         """Helper method to create labeled entry fields."""
         self.root.call(
             "grid",
-            Label(self.root, text=label_text),
-            Entry(self.root, textvariable=variable),
+            ttk.Label(self.root, text=label_text),
+            ttk.Entry(self.root, textvariable=variable),
             "-padx",
             "10",
             "-pady",
@@ -141,8 +179,8 @@ class ImageAnnotatorApp:
 
     def __create_combobox(self, label_text, variable, values, default=None):
         """Helper method to create labeled entry fields."""
-        label = Label(self.root, text=label_text)
-        combobox = AutocompleteCombobox(self.root, textvariable=variable, completevalues=values)
+        label = ttk.Label(self.root, text=label_text)
+        combobox = autocomplete.AutocompleteCombobox(self.root, textvariable=variable, completevalues=values)
         self.root.call("grid", label, combobox, "-padx", "10", "-pady", "5")
 
         if default:
@@ -167,69 +205,111 @@ class ImageAnnotatorApp:
             return False
         return True
 
+    def __build_index(self):
+        """Build the sorted positions of navigable and unprocessed rows, only on load and after compaction."""
+        visible = np.ones(len(self.data), dtype=bool)
+
+        for column, value in self.filters.items():
+            values = self.data[column]
+            if value == "":
+                visible &= (values.isna() | (values.astype(str) == "")).to_numpy()
+            else:
+                visible &= (values.astype(str) == value).to_numpy()
+
+        processed = self.data["processed"].fillna(False).astype(bool).to_numpy()  # Unreviewed rows of combined csv
+
+        self.column_index = {column: i for i, column in enumerate(self.data.columns)}
+        self.deleted_rows = []
+        self.visible_rows = PositionSet(np.flatnonzero(visible))
+        self.unprocessed_rows = PositionSet(np.flatnonzero(visible & ~processed))
+
+    def __value(self, column, position=None):
+        """Value of a column at the current row, or at the given row position."""
+        return self.data.iat[self.index if position is None else position, self.column_index[column]]
+
     def __display_image(self):
         """Display the current image with annotations."""
-        row = self.data.iloc[self.index]
-        image_path = row.iloc[0]
-        image_name = row.iloc[1]
+        value = self.__value
+        image_path = self.data.iat[self.index, 0]
+        image_name = self.data.iat[self.index, 1]
         full_image_path = Path(image_path) / image_name
 
         # fmt: off
         # Overwrite the display value
-        if "lp" in row:
-            self.lp_var.set(row["lp"])
-        if "make" in row:
-            self.make_var.set(row["make"]) if not pd.isna(row["make"]) else self.make_var.set("")
-        if "type" in row:
-            self.type_var.set(row["type"]) if not pd.isna(row["type"]) else self.type_var.set("")
-        if "colour" in row:
-            self.colour_var.set(row["colour"]) if not pd.isna(row["colour"]) else self.colour_var.set("")
-        if "environment" in row:
-            if not pd.isna(row["environment"]): self.env_var.set(row["environment"])
-        if "isBack" in row:
-            self.isback_var.set(str(row["isBack"])) if not pd.isna(row["isBack"]) else self.isback_var.set(False)
-
-        processed_status = "✔️ Processed ✔️" if row["processed"] else "✗ Not Processed ✗"
+        if "lp" in self.column_index:
+            self.lp_var.set(value("lp"))
+        if "make" in self.column_index:
+            self.make_var.set(value("make")) if not pd.isna(value("make")) else self.make_var.set("")
+        if "type" in self.column_index:
+            self.type_var.set(value("type")) if not pd.isna(value("type")) else self.type_var.set("")
+        if "colour" in self.column_index:
+            self.colour_var.set(value("colour")) if not pd.isna(value("colour")) else self.colour_var.set("")
+        if "environment" in self.column_index:
+            if not pd.isna(value("environment")): self.env_var.set(value("environment"))
+        if "isBack" in self.column_index:
+            self.isback_var.set(str(value("isBack"))) if not pd.isna(value("isBack")) else self.isback_var.set(False)
+
+        processed_status = "✔️ Processed ✔️" if value("processed") else "✗ Not Processed ✗"
+        progress = f"{len(self.visible_rows) - len(self.unprocessed_rows)}/{len(self.visible_rows)} processed"
 
         if os.path.exists(full_image_path):
-            img = Image.open(full_image_path)
-            draw = ImageDraw.Draw(img)
-            lp_img = None
-
-            if np.isin(['x1', 'y1', 'x2', 'y2'], row.keys()).all():
-                lp_img = img.crop((row['x1'], row['y1'], row['x2'], row['y2']))
-
-                draw.rectangle(
-                    [row["x1"], row["y1"], row["x2"], row["y2"]],
-                    outline="aquamarine",
-                    width=2,
-                )
-
-            img.thumbnail((500, 440))
-            img_tk = ImageTk.PhotoImage(img)
+            prepared = self.prefetcher.get(full_image_path, self.__get_box(self.index))
+            instrument.count(files=1)
+            img_tk = ImageTk.PhotoImage(prepared.image)
 
             self.image_label.config(image=img_tk)
             self.image_label.image = img_tk  # Keep a reference to avoid garbage collection
             self.status_label.config(
-                text=f"File: {image_name} \n {self.index + 1}/{len(self.data)}\n{processed_status}"
+                text=f"File: {image_name} \n {self.index + 1}/{len(self.data)} ({progress})\n{processed_status}"
             )
 
             # Display zoom license plate image
-            if lp_img:
-                (width, height) = (lp_img.width * 3, lp_img.height * 3)
-                im_resized = lp_img.resize((width, height))
-                lp_img_tk = ImageTk.PhotoImage(im_resized)
+            if prepared.lp_image:
+                lp_img_tk = ImageTk.PhotoImage(prepared.lp_image)
                 self.lp_image_label.config(image=lp_img_tk, text='ORIGINAL', compound='bottom')
                 self.lp_image_label.image = lp_img_tk  # Keep a reference to avoid garbage collection
 
-                resampled_im_resized = lp_img.resize((width, height), Image.LANCZOS)
-                resampled_lp_img_tk = ImageTk.PhotoImage(resampled_im_resized)
+                resampled_lp_img_tk = ImageTk.PhotoImage(prepared.lp_image_lanczos)
                 self.resampled_lp_image_label.config(image=resampled_lp_img_tk, text='LANCZOS', compound='bottom')
                 self.resampled_lp_image_label.image = resampled_lp_img_tk  # Keep a reference to avoid garbage collection
         else:
             self.status_label.config(text=f"Image not found: {full_image_path}")
         # fmt: on
 
+        self.__prefetch_neighbours()
+
+    def __get_box(self, position):
+        """Plate box of the row, None if the data has no box."""
+        if np.isin(["x1", "y1", "x2", "y2"], list(self.column_index)).all():
+            return tuple(self.__value(column, position) for column in ("x1", "y1", "x2", "y2"))
+        return None
+
+    def __prefetch_neighbours(self):
+        """Prepare the images of the next and previous rows in background, nearest first."""
+        items = []
+        next_position = previous_position = self.index
+
+        for _ in range(self.prefetch):
+            next_position = self.visible_rows.next(next_position) if next_position is not None else None
+            previous_position = self.visible_rows.previous(previous_position) if previous_position is not None else None
+
+            for position in (next_position, previous_position):
+                if position is not None:
+                    image_file = Path(self.data.iat[position, 0]) / self.data.iat[position, 1]
+                    items.append((image_file, self.__get_box(position)))
+
+        self.prefetcher.prefetch(items)
+
+    def __compact(self):
+        """Drop deleted rows, write the csv and rebuild the row index."""
+        deleted_rows = np.sort(self.deleted_rows)
+        self.data.drop(deleted_rows, inplace=True)
+        self.edit_log.compact(self.data)
+        write_sidecar(self.csv_file, self.data)
+
+        self.index -= int(np.searchsorted(deleted_rows, self.index))
+        self.__build_index()
+
     # Event related function
     def __update_entry(self):
         """Validate and update the current entry."""
@@ -245,14 +325,23 @@ class ImageAnnotatorApp:
             return
 
         if self.__validate_inputs(new_lp, new_make, new_type, new_colour, new_env):
-            self.data.at[self.index, "lp"] = new_lp
-            self.data.at[self.index, "make"] = new_make
-            self.data.at[self.index, "type"] = new_type
-            self.data.at[self.index, "colour"] = new_colour
-            self.data.at[self.index, "environment"] = new_env
-            self.data.at[self.index, "isBack"] = new_isback
-            self.data.at[self.index, "processed"] = True
-            self.data.to_csv(self.csv_file, index=False)
+            values = {
+                "lp": new_lp,
+                "make": new_make,
+                "type": new_type,
+                "colour": new_colour,
+                "environment": new_env,
+                "isBack": new_isback,
+                "processed": True,
+            }
+
+            for column, value in values.items():
+                self.data.at[self.index, column] = value
+
+            self.unprocessed_rows.discard(self.index)
+            self.edit_log.update(self.index, values)
+            instrument.count(updates=1)
+            self.__compact_if_needed()
             messagebox.showinfo("Info", "Updated filename successfully!")
             self.__load_next_image()
 
@@ -261,24 +350,47 @@ class ImageAnnotatorApp:
         selected = messagebox.askquestion("Delete", "Are you sure you want to delete this image?", icon="warning")
 
         if selected == "yes":
-            self.data.drop(self.index, inplace=True)
-            self.data.reset_index(inplace=True, drop=True)
-            self.data.to_csv(self.csv_file, index=False)
+            self.deleted_rows.append(self.index)
+            self.visible_rows.discard(self.index)
+            self.unprocessed_rows.discard(self.index)
+            self.edit_log.delete(self.index)
+            instrument.count(deletes=1)
+
+            # Move to the next row, or the previous row if it was the last one
+            position = self.visible_rows.next(self.index)
+            position = position if position is not None else self.visible_rows.previous(self.index)
+
+            if position is not None:
+                self.index = position
+
+            self.__compact_if_needed()
             messagebox.showinfo("Info", "Deleted successfully!")
+
+            if position is None:
+                messagebox.showinfo("Info", "No image left.")
+                return
+
             self.__display_image()
 
+    def __compact_if_needed(self):
+        """Write the edits back to the csv once enough edits are in the journal."""
+        if self.edit_log.should_compact:
+            self.__compact()
+
     def __load_next_image(self):
         """Load the next image."""
-        if self.index < len(self.data) - 1:
-            self.index += 1
+        position = self.visible_rows.next(self.index)
+        if position is not None:
+            self.index = position
             self.__display_image()
         else:
             messagebox.showinfo("Info", "Already at the last image.")
 
     def __load_previous_image(self):
         """Load the previous image."""
-        if self.index > 0:
-            self.index -= 1
+        position = self.visible_rows.previous(self.index)
+        if position is not None:
+            self.index = position
             self.__display_image()
         else:
             messagebox.showinfo("Info", "Already at the first image.")
@@ -287,14 +399,28 @@ class ImageAnnotatorApp:
         """Prompt for a row number and display that image."""
         n = simpledialog.askinteger("Go to Row", "Enter the row number:", minvalue=1, maxvalue=len(self.data))
         if n is not None and 1 <= n <= len(self.data):
+            if n - 1 not in self.visible_rows:
+                messagebox.showinfo("Info", f"Row {n} is deleted or filtered out.")
+                return
+
             self.index = n - 1  # Convert to 0-based index
             self.__display_image()
 
     def __start_from_first_unprocessed(self):
         """Start displaying images from the first unprocessed entry."""
-        unprocessed = self.data[self.data["processed"] == False]
-        if not unprocessed.empty:
-            self.index = unprocessed.index[0]
+        position = self.unprocessed_rows.first()
+        if position is not None:
+            self.index = position
+            self.__display_image()
+        else:
+            messagebox.showinfo("Info", "All entries are processed.")
+
+    def __go_to_next_unprocessed(self):
+        """Display the next unprocessed entry after the current one, wrapping around to the first."""
+        position = self.unprocessed_rows.next(self.index)
+        position = position if position is not None else self.unprocessed_rows.first()
+        if position is not None:
+            self.index = position
             self.__display_image()
         else:
             messagebox.showinfo("Info", "All entries are processed.")
@@ -306,6 +432,36 @@ if __name__ == "__main__":
     # Add arguments
     parser.add_argument("csv", type=str, help="Input csv that generate from yolo_to_csv")
     parser.add_argument("-c", "--config", type=str, help="Config file path", default="config.yml")
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Number of next and previous images prepared in background. (default: %(default)s)",
+        default=4,
+    )
+    parser.add_argument(
+        "--cache_mb", type=int, help="Memory budget of prepared images in MiB. (default: %(default)s)", default=256
+    )
+    parser.add_argument(
+        "--compact_every",
+        type=int,
+        help="Number of edits kept in the journal before the csv is rewritten. (default: %(default)s)",
+        default=1000,
+    )
+    parser.add_argument(
+        "-f",
+        "--filter",
+        type=str,
+        nargs="+",
+        help="Only navigate rows matching all COLUMN=VALUE, empty VALUE for missing, e.g. environment=night make=",
+        default=[],
+    )
+    parser.add_argument(
+        "--thumbnail_cache",
+        action="store_true",
+        help="Keep decoded thumbnails in .thumbnails next to the csv, to reopen a session without decoding",
+    )
+
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
 
@@ -313,5 +469,18 @@ if __name__ == "__main__":
     if not args.csv.endswith(".csv"):
         parser.error(Fore.RED + "Input file must end with .csv")
 
-    app = ImageAnnotatorApp(args.csv, config_file=args.config)
-    app.start()
+    # Check that filters are COLUMN=VALUE
+    if not all("=" in f for f in args.filter):
+        parser.error(Fore.RED + "Filter must be COLUMN=VALUE")
+
+    with instrument.run(args):
+        app = ImageAnnotatorApp(
+            args.csv,
+            config_file=args.config,
+            prefetch=args.prefetch,
+            cache_mb=args.cache_mb,
+            compact_every=args.compact_every,
+            filters=dict(f.split("=", 1) for f in args.filter),
+            thumbnail_cache=Path(args.csv).parent / ".thumbnails" if args.thumbnail_cache else None,
+        )
+        app.start()
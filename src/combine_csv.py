@@ -1,54 +1,276 @@
+from __future__ import annotations
+
 import argparse
+import os
 import sys
+from enum import Enum
 from pathlib import Path
 
 import colorama
-import pandas as pd
 from colorama import Fore
 
+from src.utils import instrument, lazy_import, load_yaml_file
+from src.utils.table_io import (
+    TABLE_SUFFIXES,
+    TableFormat,
+    TableWriter,
+    config_categories,
+    read_table_chunks,
+    table_columns,
+)
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
 colorama.init()
 
 
-def filter_lp(data: pd.DataFrame) -> pd.DataFrame:
-    # REGEX Filters
-    regex_filters = ["^[A-Z]+[0-9]+[A-Z]*$", "^CANNOT$"]
-    final_regex = f"({'|'.join([f'({regex})' for regex in regex_filters])})"
+class KeepMode(Enum):
+    first = 1  # first row of each license plate, in input order
+    best = 2  # row with the largest plate box of each license plate, independent of input order
+    default = first
 
-    temp_df = data[data["lp"] == "CANNOT"]
-    df = data[data["lp"] != "CANNOT"]
+    @classmethod
+    def all_option(cls):
+        return [mode.name for mode in list(KeepMode)]
 
-    df = df.drop_duplicates(subset=["lp"])
-    df = pd.concat([df, temp_df])
 
-    return df[df["lp"].str.match(final_regex)]
+# REGEX Filters, joined once at import
+REGEX_FILTERS = ["^[A-Z]+[0-9]+[A-Z]*$", "^CANNOT$"]
+LP_REGEX = f"({'|'.join([f'({regex})' for regex in REGEX_FILTERS])})"
+UNREADABLE_LP = "CANNOT"  # Every unreadable plate is kept, it is not a duplicate
 
 
-def combine_csv(csv_files: list[str], output_file: str, filter: bool = False):
-    """Combine all csv files input one csv file."""
+def plate_hashes(lp: pd.Series) -> np.ndarray:
+    """64-bit hash of every license plate, stable across runs."""
+    return pd.util.hash_array(lp.to_numpy(dtype=object))
 
-    if not isinstance(output_file, Path):
-        output_file = Path(output_file)
 
-    # Initialize the full DataFrame
-    df_full = pd.DataFrame()
+def row_hashes(data: pd.DataFrame) -> np.ndarray:
+    """64-bit hash of every row content, stable across runs."""
+    return pd.util.hash_pandas_object(data, index=False).to_numpy()
+
+
+def plate_scores(data: pd.DataFrame) -> np.ndarray:
+    """Plate box area of every row, larger is better. -1 for rows without a box."""
+    if not {"x1", "y1", "x2", "y2"}.issubset(data.columns):
+        return np.full(len(data), -1.0)
+
+    x1, y1, x2, y2 = (
+        pd.to_numeric(data[col], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        for col in ("x1", "y1", "x2", "y2")
+    )
+    return np.nan_to_num((x2 - x1) * (y2 - y1), nan=-1.0)
+
+
+def _dedup_mask(data: pd.DataFrame) -> np.ndarray:
+    """Rows with a valid license plate that take part in dedup, all but the unreadable plates."""
+    lp = data["lp"]
+    is_valid = lp.str.match(LP_REGEX, na=False).to_numpy(dtype=bool, na_value=False)
+    return is_valid & (lp != UNREADABLE_LP).to_numpy(dtype=bool, na_value=False)
+
+
+def find_best_plates(frames) -> tuple[np.ndarray, np.ndarray]:
+    """First pass of KeepMode.best, find the best row of every license plate.
+
+    Only the plate hash, score and row hash of every row are kept, 24 bytes per row.
+
+    Args:
+        frames (iterable): DataFrame chunks of all input
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: sorted plate hashes and the row hash of the best row of each plate
+    """
+    lp_hash, score, row_hash = [np.empty(0, dtype=np.uint64)], [np.empty(0)], [np.empty(0, dtype=np.uint64)]
+
+    for data in frames:
+        data = data[_dedup_mask(data)]
+        lp_hash.append(plate_hashes(data["lp"]))
+        score.append(plate_scores(data))
+        row_hash.append(row_hashes(data))
+
+    lp_hash, score, row_hash = np.concatenate(lp_hash), np.concatenate(score), np.concatenate(row_hash)
+
+    # Highest score first, ties broken by row hash so the result does not depend on input order
+    order = np.lexsort((row_hash, -score, lp_hash))
+    lp_hash, row_hash = lp_hash[order], row_hash[order]
+    first = np.r_[True, lp_hash[1:] != lp_hash[:-1]] if len(lp_hash) else np.empty(0, dtype=bool)
+
+    return lp_hash[first], row_hash[first]
+
+
+class PlateFilter:
+    """Global license plate filter applied chunk by chunk.
+
+    Rows with invalid license plate are dropped, and only one row of every license plate is kept across all chunks.
+    Seen plates are kept as a sorted array of 64-bit hashes, 8 bytes per plate.
+
+    Args:
+        keep (KeepMode): which row of every license plate to keep
+        best (tuple, optional): result of find_best_plates over the same input, required for KeepMode.best
+    """
+
+    def __init__(self, keep: KeepMode = KeepMode.first, best: tuple = None):
+        if keep is KeepMode.best and best is None:
+            raise ValueError("KeepMode.best requires the result of find_best_plates")
+
+        self.keep = keep
+        self.seen = np.empty(0, dtype=np.uint64)
+        self.best_lp_hash, self.best_row_hash = best if best is not None else (None, None)
+        self.emitted = np.zeros(len(self.best_lp_hash), dtype=bool) if best is not None else None
+
+    def __call__(self, data: pd.DataFrame) -> pd.DataFrame:
+        keep = (data["lp"] == UNREADABLE_LP).to_numpy(dtype=bool, copy=True, na_value=False)
+        dedup = np.flatnonzero(_dedup_mask(data))
+        lp_hash = plate_hashes(data["lp"].iloc[dedup])
+
+        if self.keep is KeepMode.best:
+            index = np.searchsorted(self.best_lp_hash, lp_hash).clip(max=len(self.best_lp_hash) - 1)
+            is_best = self.best_row_hash[index] == row_hashes(data.iloc[dedup])
+            is_best &= ~self.emitted[index]
+
+            # Identical best rows, keep the first one
+            _, first = np.unique(index[is_best], return_index=True)
+            keep[dedup[np.flatnonzero(is_best)[first]]] = True
+            self.emitted[index[is_best]] = True
+        else:
+            index = np.searchsorted(self.seen, lp_hash).clip(max=max(len(self.seen) - 1, 0))
+            is_seen = self.seen[index] == lp_hash if len(self.seen) else np.zeros(len(lp_hash), dtype=bool)
+
+            # First occurrence of every plate in this chunk, not seen in the previous chunks
+            _, first = np.unique(lp_hash, return_index=True)
+            is_new = np.zeros(len(lp_hash), dtype=bool)
+            is_new[first] = True
+            is_new &= ~is_seen
+
+            keep[dedup[is_new]] = True
+            # Merge the new plates into the sorted seen plates, linear in the seen plates instead of a full sort
+            new = np.sort(lp_hash[is_new])
+            self.seen = np.insert(self.seen, np.searchsorted(self.seen, new), new)
+
+        return data[keep]
+
+
+def filter_lp(data: pd.DataFrame, keep: KeepMode = KeepMode.first) -> pd.DataFrame:
+    """Drop invalid and duplicate license plates of one DataFrame, see PlateFilter."""
+    best = find_best_plates([data]) if keep is KeepMode.best else None
+    return PlateFilter(keep, best)(data)
+
+
+def get_output_columns(csv_files: list, header: list = None) -> list:
+    """Columns of the combined file, read from the header line or schema of every input file.
+
+    Args:
+        csv_files (list): list of csv, parquet or feather files
+        header (list, optional): allowed columns in their output order, e.g. processed_data_header in config
+
+    Returns:
+        list: union of columns of all files, ordered as header if given, else in order of appearance
+    """
+    columns = {}
 
-    # Combine csv files
     for csv_file in csv_files:
         try:
-            data = pd.read_csv(csv_file)
-            print(f"Original {csv_file}: {data.shape}")
+            file_columns = table_columns(csv_file)
         except FileNotFoundError:
             print(f"File {csv_file} NOT FOUND")
             sys.exit(1)
 
-        if filter:
-            data = filter_lp(data)  # fmt: skip
+        if header is not None and (unknown := set(file_columns) - set(header)):
+            raise ValueError(f"{csv_file} has columns not in processed_data_header: {sorted(unknown)}")
+
+        columns.update(dict.fromkeys(file_columns))
+
+    if header is not None:
+        return [column for column in header if column in columns]
+
+    return list(columns)
+
+
+def combine_csv(
+    csv_files: list[str],
+    output_file: str,
+    filter: bool = False,
+    header: list = None,
+    chunk_size: int = 100_000,
+    keep: KeepMode = KeepMode.first,
+    categories: dict = None,
+    source_column: str = None,
+):
+    """Combine all csv files input one csv file.
+
+    Every input file is appended to output file in chunks of chunk_size rows, so the run time is linear in the total
+    number of rows and memory is bounded by the chunk size. csv values are copied as text without type conversion.
+    A file missing some of the columns gets empty values. Inputs and output can be csv, parquet or feather files, by
+    extension, see TableWriter for the column types of parquet and feather output.
+
+    With filter, rows with invalid license plate are dropped and every license plate is kept once across all files,
+    see PlateFilter. KeepMode.best reads the input twice, to pick the best row of each plate first.
+
+    Args:
+        csv_files (list): list of csv, parquet or feather files
+        output_file (str): output csv, parquet or feather file
+        filter (bool, optional): whether to filter license plate. Defaults to False.
+        header (list, optional): allowed columns, e.g. processed_data_header in config. Defaults to no check.
+        chunk_size (int, optional): number of rows read at a time. Defaults to 100_000.
+        keep (KeepMode, optional): which row of each license plate to keep with filter. Defaults to first.
+        categories (dict, optional): allowed values of categorical columns of parquet and feather output, see
+            config_categories. Defaults to none.
+        source_column (str, optional): name of a column set to the folder name of every input file without it, the
+            data source of processed files. Defaults to no column.
+    """
+
+    if not isinstance(output_file, Path):
+        output_file = Path(output_file)
+
+    columns = get_output_columns(csv_files, header)
+    total_rows = 0
+
+    if source_column is not None and source_column not in columns:
+        columns.append(source_column)
+
+    def read_chunks(csv_file):
+        return read_table_chunks(csv_file, chunk_size, dtype=str, keep_default_na=False)
+
+    if filter:
+        best = None
+
+        if keep is KeepMode.best:
+            with instrument.stage("find_best_plates"):
+                best = find_best_plates(chunk for csv_file in csv_files for chunk in read_chunks(csv_file))
+
+        plate_filter = PlateFilter(keep, best)
 
-        df_full = pd.concat([df_full, data])
+    with (
+        instrument.stage("combine"),
+        instrument.Progress(desc="Combine", unit="rows") as progress,
+        TableWriter(output_file, columns=columns, categories=categories) as writer,
+    ):
+        # Combine input files
+        for csv_file in csv_files:
+            file_rows = file_columns = 0
+            instrument.count(files=1, bytes=os.path.getsize(csv_file))
 
-    print(f"New: {df_full.shape}")
+            for data in read_chunks(csv_file):
+                file_rows += len(data)
+                file_columns = len(data.columns)
+                instrument.count(rows=len(data))
+                progress.update(len(data))
+
+                if filter:
+                    data = plate_filter(data)
+
+                # Combined files keep their source
+                if source_column is not None and source_column not in data.columns:
+                    data = data.assign(**{source_column: Path(csv_file).parent.name})
+
+                total_rows += len(data)
+                writer.write(data.reindex(columns=columns))
+
+            progress.write(f"Original {csv_file}: {(file_rows, file_columns)}")
+
+    print(f"New: {(total_rows, len(columns))}")
     print(f"File saved as {output_file}")
-    df_full.to_csv(output_file, index=False)
 
 
 if __name__ == "__main__":
@@ -57,24 +279,49 @@ if __name__ == "__main__":
         description="Combine CSV files and filter license plate if needed."
     )
 
-    parser.add_argument("csv_files", nargs="+", help="List of input folder or CSV files to combine")
+    parser.add_argument("csv_files", nargs="+", help="List of input folder or CSV, Parquet or Feather files to combine")
     parser.add_argument("-o", "--output_file", type=str, help="Output file path", required=True)
     parser.add_argument("--filter_lp", action='store_true', help="Whether to filter license plate")
+    parser.add_argument("--keep", type=str, help="Which row of each license plate to keep with --filter_lp, best is the largest plate box. (default: %(default)s)", choices=KeepMode.all_option(), default=KeepMode.default.name)
+    parser.add_argument("-c", "--config", type=str, help="Config file path, to check columns against processed_data_header and encode categorical columns")
+    parser.add_argument("--chunk_size", type=int, help="Number of rows read at a time. (default: %(default)s)", default=100_000)
+    parser.add_argument("--source_column", type=str, help="Add a column with the folder name of every input file, e.g. source")
     # fmt: on
 
+    instrument.add_arguments(parser)
+
     # Parse the arguments
     args = parser.parse_args()
 
-    # Check provided arguments are csv file
-    if not args.output_file.endswith(".csv"):
-        parser.error(Fore.RED + "Output file must end with .csv")
+    # Check provided output is a supported table file
+    try:
+        TableFormat.from_file(args.output_file)
+    except ValueError as e:
+        parser.error(Fore.RED + str(e))
 
     csv_list = []
 
     for input in args.csv_files:
-        if not input.endswith(".csv"):
-            csv_list.extend(list(Path(input).glob("**/*.csv")))
+        if Path(input).suffix.lower() not in TABLE_SUFFIXES:
+            # Sorted, glob order depends on the file system and --keep first keeps the row of the first file
+            csv_list.extend(sorted(file for file in Path(input).glob("**/*") if file.suffix.lower() in TABLE_SUFFIXES))
         else:
             csv_list.append(input)
 
-    combine_csv(csv_list, args.output_file, args.filter_lp)
+    config = load_yaml_file(args.config) if args.config else {}
+    header = config.get("processed_data_header")
+
+    with instrument.run(args):
+        try:
+            combine_csv(
+                csv_list,
+                args.output_file,
+                args.filter_lp,
+                header,
+                args.chunk_size,
+                KeepMode[args.keep],
+                config_categories(config),
+                args.source_column,
+            )
+        except ValueError as e:
+            parser.error(Fore.RED + str(e))
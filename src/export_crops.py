@@ -0,0 +1,180 @@
+import argparse
+import io
+import os
+from functools import partial
+from pathlib import Path
+
+import colorama
+from colorama import Fore
+
+from src.combine_csv import UNREADABLE_LP
+from src.scan_images import image_files
+from src.utils import bounded_map, instrument, lazy_import
+from src.utils.shards import ShardWriter
+from src.utils.table_io import TableFormat
+
+futures = lazy_import("concurrent.futures")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+colorama.init()
+
+
+def crop_plates(task: tuple, size: tuple = None, ext: str = "png") -> list:
+    """Decode an image once and encode the crop of every plate box in it.
+
+    Args:
+        task (tuple): image file, and list of (key, box, lp) of its rows
+        size (tuple, optional): (width, height) to resize the crops to with LANCZOS resampling. Defaults to no resize.
+        ext (str, optional): image format of the crops, png or jpg. Defaults to png.
+
+    Returns:
+        list: (key, encoded crop, lp) of every row, empty if the image is missing, corrupt or too large
+    """
+    image_file, rows = task
+    samples = []
+
+    try:
+        with Image.open(image_file) as img:
+            img.load()
+
+            for key, box, lp in rows:
+                crop = img.crop(box)
+                if size is not None:
+                    crop = crop.resize(size, Image.LANCZOS)
+
+                buffer = io.BytesIO()
+                crop.convert("RGB").save(buffer, format="JPEG" if ext == "jpg" else ext.upper())
+                samples.append((key, buffer.getvalue(), lp))
+    except (OSError, Image.DecompressionBombError, Image.UnidentifiedImageError):
+        return []
+
+    return samples
+
+
+def export_crops(
+    table_file: str,
+    output_folder: str,
+    image_folder: str = None,
+    size: tuple = None,
+    ext: str = "png",
+    shard_size: int = 10000,
+    workers: int = None,
+):
+    """Export the plate crop and license plate of every row of a processed or combined data file to tar shards.
+
+    Rows are grouped by image, so every image is decoded once, and the images are cropped in a process pool. Shards
+    are written in the order of the data file. Rows without license plate, unreadable plates and rows without a valid
+    box are skipped.
+
+    Args:
+        table_file (str): processed or combined csv, parquet or feather file
+        output_folder (str): folder of the tar shards
+        image_folder (str, optional): folder of the images. Defaults to the folder of table_file.
+        size (tuple, optional): (width, height) to resize the crops to with LANCZOS resampling. Defaults to no resize.
+        ext (str, optional): image format of the crops, png or jpg. Defaults to png.
+        shard_size (int, optional): number of crops per shard. Defaults to 10000.
+        workers (int, optional): number of worker processes. Defaults to number of cpu.
+    """
+    data = image_files(table_file, image_folder, columns=["lp"])
+
+    if not {"x1", "y1", "x2", "y2"}.issubset(data.columns):
+        raise ValueError(f"{table_file} has no x1, y1, x2, y2 column")
+
+    lp = data["lp"].astype(object)
+    x1, y1, x2, y2 = (data[column].to_numpy() for column in ("x1", "y1", "x2", "y2"))
+    with np.errstate(invalid="ignore"):
+        valid = (x1 < x2) & (y1 < y2) & (x1 >= 0) & (y1 >= 0)
+    valid &= data["image_file"].notna().to_numpy() & lp.notna().to_numpy() & (lp != UNREADABLE_LP).to_numpy()
+    rows = np.flatnonzero(valid)
+
+    # One task per image, with the rows of that image, in order of first appearance
+    tasks = {}
+    files = data["image_file"].to_numpy()
+    for row in rows:
+        image_file = files[row]
+        # WebDataset splits member names at the first dot, the row makes the key unique
+        key = f"{Path(image_file).stem.replace('.', '_')}_{row}"
+        box = (int(x1[row]), int(y1[row]), int(x2[row]), int(y2[row]))
+        tasks.setdefault(image_file, []).append((key, box, str(lp[row])))
+
+    os.makedirs(output_folder, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    crop = partial(crop_plates, size=size, ext=ext)
+    failed = 0
+
+    with (
+        futures.ProcessPoolExecutor(max_workers=workers) as executor,
+        ShardWriter(output_folder, shard_size=shard_size) as writer,
+    ):
+        crops = bounded_map(executor, crop, tasks.items(), 4 * workers)
+        for samples in instrument.progress(crops, len(tasks), "Crop images", "files"):
+            failed += not samples
+            instrument.count(files=1, rows=len(samples))
+
+            for key, content, plate in samples:
+                writer.write(key, {ext: content, "txt": plate.encode()})
+
+    print(
+        Fore.GREEN + f"{writer.count} crops of {len(data)} rows saved in {len(writer.shards)} shards to {output_folder}"
+    )
+    if len(data) - len(rows):
+        print(Fore.YELLOW + f"{len(data) - len(rows)} rows without license plate or valid box skipped")
+    if failed:
+        print(Fore.RED + f"{failed} images cannot be read, run scan_images.py to find them")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export plate crops and license plates to tar shards for OCR training."
+    )
+
+    # Add arguments
+    parser.add_argument("table_file", type=str, help="Processed or combined csv, parquet or feather file")
+    parser.add_argument("-o", "--output_folder", type=str, help="Output folder of the tar shards", required=True)
+    parser.add_argument("--image_folder", type=str, help="Folder of the images, default to the folder of table_file")
+    parser.add_argument(
+        "--size",
+        type=int,
+        nargs=2,
+        metavar=("WIDTH", "HEIGHT"),
+        help="Resize the crops with LANCZOS resampling",
+    )
+    parser.add_argument(
+        "--ext",
+        type=str,
+        help="Image format of the crops. (default: %(default)s)",
+        choices=["png", "jpg"],
+        default="png",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        help="Number of crops per shard. (default: %(default)s)",
+        default=10000,
+    )
+    parser.add_argument("-w", "--workers", type=int, help="Number of worker processes, default to number of cpu")
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    # Check that input file is a supported table format
+    try:
+        TableFormat.from_file(args.table_file)
+    except ValueError as e:
+        parser.error(Fore.RED + str(e))
+
+    with instrument.run(args):
+        try:
+            export_crops(
+                args.table_file,
+                args.output_folder,
+                args.image_folder,
+                tuple(args.size) if args.size else None,
+                args.ext,
+                args.shard_size,
+                args.workers,
+            )
+        except ValueError as e:
+            parser.error(Fore.RED + str(e))
@@ -1,56 +1,210 @@
+from __future__ import annotations
+
 import argparse
+import csv
 import os
-import shutil
+from functools import partial
 from pathlib import Path
 
 import colorama
-import pandas as pd
 from colorama import Fore
 
-from src.utils import generate_md5_file, load_yaml_file
+from src.utils import (
+    PART_SUFFIX,
+    StorageMode,
+    bounded_map,
+    copy_file_md5,
+    instrument,
+    lazy_import,
+    load_yaml_file,
+)
+from src.utils.table_io import TableFormat, config_categories, read_table, write_table
+
+futures = lazy_import("concurrent.futures")
+pd = lazy_import("pandas")
 
 colorama.init()
 
+MANIFEST_FILE = "processed_manifest.tsv"
+
+
+def _source_key(file: str) -> tuple[str, str]:
+    """Size and modification time of a source image, as written in the manifest."""
+    stat = os.stat(file)
+    return str(stat.st_size), str(stat.st_mtime_ns)
+
+
+def load_manifest(manifest_file: str, output_folder: str) -> dict:
+    """Load the completed copies recorded by a previous run.
+
+    Every entry records the size and mtime of its old image, like HashCache. Entries whose old image was replaced or
+    modified since, whose new image is missing from output folder, or the incomplete last line of an interrupted run,
+    are ignored so that image is processed again.
+
+    Args:
+        manifest_file (str): Manifest file path.
+        output_folder (str): Output folder of the new images.
+
+    Returns:
+        dict: Mapping of full old image path to new image name.
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+
+    new_image_names = {}
+
+    with open(manifest_file, "r", newline="") as f:
+        for row in csv.reader(f, delimiter="\t"):
+            if len(row) != 4 or not os.path.exists(os.path.join(output_folder, row[3])):
+                continue
+
+            try:
+                is_current = _source_key(row[0]) == (row[1], row[2])
+            except OSError:
+                is_current = False
+
+            # A later entry of the same image, processed again after it changed, replaces the earlier one
+            if is_current:
+                new_image_names[row[0]] = row[3]
+            else:
+                new_image_names.pop(row[0], None)
+
+    return new_image_names
+
+
+def _copy_image(file: str, **kwargs) -> tuple[tuple[str, str], str]:
+    """Source key of an old image, taken before it is read, and its new image name, see copy_file_md5."""
+    key = _source_key(file)
+    return key, copy_file_md5(file, **kwargs)
+
+
+def old_image_file_keys(df: pd.DataFrame, path_col_name: str, name_col_name: str) -> pd.Series:
+    """Full path of the old image of every row, used as the key to join new image names back.
+
+    Args:
+        df (pd.DataFrame): Interim data.
+        path_col_name (str): Column of old image folder.
+        name_col_name (str): Column of old image name.
+
+    Returns:
+        pd.Series: Full old image path as string, aligned with df.
+    """
+    return pd.Series(
+        [os.path.join(path, name) for path, name in zip(df[path_col_name], df[name_col_name])],
+        index=df.index,
+        dtype=object,
+    )
+
+
+def assign_new_image_names(df: pd.DataFrame, old_image_files: pd.Series, new_image_names: dict):
+    """Set new_image_name of every row in place from a mapping of old image path to new image name.
+
+    The mapping is joined on the full old image path with one hash lookup per row, so images with the same name in
+    different folders get their own new name. Rows without an entry keep their current new_image_name, if any.
+
+    Args:
+        df (pd.DataFrame): Interim data.
+        old_image_files (pd.Series): Full old image path of every row, from old_image_file_keys.
+        new_image_names (dict): Mapping of full old image path to new image name.
+    """
+    new_image_name = old_image_files.map(new_image_names)
+
+    if "new_image_name" in df.columns:
+        new_image_name = new_image_name.fillna(df["new_image_name"])
+
+    df["new_image_name"] = new_image_name
 
-def interim_to_processed(csv_file: str, output_folder: str, config_file: str = "config.yaml"):
+
+def interim_to_processed(
+    csv_file: str,
+    output_folder: str,
+    config_file: str = "config.yaml",
+    workers: int = None,
+    resume: bool = True,
+    storage: StorageMode = StorageMode.copy,
+    output_format: TableFormat = TableFormat.csv,
+):
     """It provides a reference pipeline from interim to processed data.
 
     Rename image with new unique filename using md5
     Remove all attributes not in processed_data_header in config.yaml
     Move old image to new path
-    Save the .csv
+    Save the processed data as .csv, .parquet or .feather
+
+    Every copied image is appended to processed_manifest.tsv in output folder as soon as it is done, with the size and
+    mtime of the old image. A rerun, after an interruption or on a grown interim csv, only copies the images not in
+    the manifest yet, or modified since.
 
     Args:
-        csv_file (str): Interim csv file.
+        csv_file (str): Interim csv, parquet or feather file.
         output_folder (str): Output folder path.
         config_file (str, optional): Path to config file. Defaults to "config.yaml".
+        workers (int, optional): Number of threads hashing and copying images. Defaults to thread pool default.
+        resume (bool, optional): Whether to skip images recorded in the manifest. Defaults to True.
+        storage (StorageMode, optional): Copy, hardlink or reflink the new images. Images with the same md5 are
+            stored once. Defaults to copy.
+        output_format (TableFormat, optional): Format of the processed data file. Parquet and feather store make,
+            type, colour and environment as categoricals of the config values. Defaults to csv.
     """
     if not isinstance(output_folder, Path):
         output_folder = Path(output_folder)
 
     config = load_yaml_file(config_file)
-    df = pd.read_csv(csv_file)
+
+    with instrument.stage("read"):
+        df = read_table(csv_file)
+        instrument.count(rows=len(df))
 
     old_image_path_col_name = config["yolo_to_csv_header"][0]
     old_image_name_col_name = config["yolo_to_csv_header"][1]
 
-    # Rename image with new unique filename using md5
-    for _, row in df.iterrows():
-        full_old_image_path = Path(row[old_image_path_col_name]) / row[old_image_name_col_name]
+    old_image_files = old_image_file_keys(df, old_image_path_col_name, old_image_name_col_name)
+
+    # Images completed by a previous run are not copied again
+    manifest_file = output_folder / MANIFEST_FILE
+    new_image_names = load_manifest(manifest_file, output_folder) if resume else {}
+
+    # Each image is copied once, even if it appears in many rows. Only existing images are renamed
+    unique_files = [file for file in old_image_files.unique() if file not in new_image_names and os.path.exists(file)]
 
-        if full_old_image_path.exists():
-            new_image_name = generate_md5_file(full_old_image_path) + full_old_image_path.suffix
-            new_image_file = output_folder / new_image_name
+    # Rename image with new unique filename using md5, hashed while it is copied into new directory
+    os.makedirs(output_folder, exist_ok=True)
+    for part_file in output_folder.glob(f"*{PART_SUFFIX}"):  # Left by a killed run
+        part_file.unlink()
 
-            # Copy the image into new directory
-            os.makedirs(os.path.dirname(new_image_file), exist_ok=True)
-            shutil.copy(full_old_image_path, new_image_file)
+    copy_image = partial(_copy_image, output_folder=output_folder, storage=storage)
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
 
-            df.loc[df["old_image_name"] == row[old_image_name_col_name], ["new_image_name"]] = new_image_name
+    with (
+        instrument.stage("copy_images"),
+        instrument.Progress(len(unique_files), "Copy images", "files") as progress,
+        futures.ThreadPoolExecutor(max_workers=workers) as executor,
+        open(manifest_file, "a" if resume else "w", newline="", buffering=1) as manifest,
+    ):
+        writer = csv.writer(manifest, delimiter="\t", lineterminator="\n")
+
+        # Terminate the incomplete last line of an interrupted run
+        if manifest.tell() > 0:
+            with open(manifest_file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    manifest.write("\n")
+
+        for file, (key, new_image_name) in zip(
+            unique_files, bounded_map(executor, copy_image, unique_files, 4 * workers)
+        ):
+            writer.writerow((file, *key, new_image_name))
+            new_image_names[file] = new_image_name
+            instrument.count(files=1, bytes=os.path.getsize(output_folder / new_image_name))
+            progress.update()
+
+    assign_new_image_names(df, old_image_files, new_image_names)
 
     # Remove all attributes not in processed_data_header in config
     df = df.filter(config["processed_data_header"])
-    df.to_csv(output_folder / "processed_data.csv", index=False)
+
+    with instrument.stage("write"):
+        write_table(df, output_folder / f"processed_data{output_format.suffix}", config_categories(config))
 
     print(Fore.GREEN + "Completed")
     print(Fore.BLUE + "Remember to update 3-processed/README.md and combine all the processed data")
@@ -63,11 +217,42 @@ if __name__ == "__main__":
     parser.add_argument("csv_file", type=str, help="Interim csv file")
     parser.add_argument("-o", "--output_folder", type=str, help="Output folder", required=True)
     parser.add_argument("-c", "--config", type=str, help="Config file path", default="config.yml")
+    parser.add_argument("-w", "--workers", type=int, help="Number of threads hashing and copying images")
+    parser.add_argument("--no_resume", action="store_true", help="Copy all images again, ignore the manifest")
+    parser.add_argument(
+        "-s",
+        "--storage",
+        type=str,
+        help="How to store new images, hardlink and reflink fall back to copy. (default: %(default)s)",
+        choices=StorageMode.all_option(),
+        default=StorageMode.default.name,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        help="Format of the processed data file. (default: %(default)s)",
+        choices=TableFormat.all_option(),
+        default=TableFormat.default.name,
+    )
+
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
 
-    # Check that output file ends with .csv
-    if not args.csv_file.endswith(".csv"):
-        parser.error(Fore.RED + "Input file must end with .csv")
+    # Check that input file is a supported table format
+    try:
+        TableFormat.from_file(args.csv_file)
+    except ValueError as e:
+        parser.error(Fore.RED + str(e))
 
-    interim_to_processed(args.csv_file, args.output_folder, args.config)
+    with instrument.run(args):
+        interim_to_processed(
+            args.csv_file,
+            args.output_folder,
+            args.config,
+            args.workers,
+            not args.no_resume,
+            StorageMode[args.storage],
+            TableFormat[args.format],
+        )
@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import os
+from pathlib import Path
+
+import colorama
+from colorama import Fore
+
+from src.scan_images import find_table_files, image_files, image_key
+from src.utils import bounded_map, instrument, lazy_import
+from src.utils.table_io import TableFormat, read_table, write_table
+
+futures = lazy_import("concurrent.futures")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+Image = lazy_import("PIL.Image")
+
+colorama.init()
+
+DHASH_FILE = "dhash_index.tsv"
+HASH_BITS = 64
+MAX_COMPARISONS = 100_000_000  # candidate pairs of a block to warn about, each one is a Hamming distance
+
+
+def dhash(image_file: str) -> int | None:
+    """64-bit difference hash of an image, None if it cannot be read.
+
+    The image is reduced to 9x8 grayscale pixels, every bit tells whether a pixel is brighter than its right neighbour.
+    Re-encoding, resizing and small changes between video frames change few bits.
+    """
+    try:
+        with Image.open(image_file) as img:
+            img.draft("L", (64, 64))  # Decode JPEG at reduced scale, the hash only needs 9x8 pixels
+            pixels = np.asarray(img.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    except OSError:
+        return None
+
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def load_dhashes(dhash_file: str) -> dict:
+    """Load the cached dHash of every image, mapping md5 to hash. Incomplete last line is ignored."""
+    if not os.path.exists(dhash_file):
+        return {}
+
+    with open(dhash_file, "r", newline="") as f:
+        return {row[0]: int(row[1], 16) for row in csv.reader(f, delimiter="\t") if len(row) == 2 and len(row[1]) == 16}
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Number of different bits of every pair of 64-bit hashes."""
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(a ^ b)
+    return np.unpackbits((a ^ b).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def _bucket_sizes(keys: np.ndarray) -> np.ndarray:
+    """Number of keys of every distinct key."""
+    sorted_keys = np.sort(keys)
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(keys) else np.empty(0, dtype=int)
+    return np.diff(np.r_[starts, len(keys)])
+
+
+def _bucket_pairs(keys: np.ndarray):
+    """All pairs of indices with the same key, without comparing keys across buckets.
+
+    The work is proportional to the number of pairs, not to the number of keys squared. Pairs are yielded in chunks
+    of at most len(keys) pairs, so they can be filtered without holding all of them in memory.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray]: indices of the two keys of every pair of a chunk
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    is_start = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+    starts = np.flatnonzero(is_start)
+    ends = np.r_[starts[1:], len(keys)]
+    end = np.repeat(ends, ends - starts)
+
+    position = np.arange(len(keys))
+    offset = 1
+
+    # Compare every element with the one offset places further in its bucket, as long as the bucket goes that far
+    while len(position := position[position + offset < end[position]]):
+        yield order[position], order[position + offset]
+        offset += 1
+
+
+def near_duplicate_pairs(hashes: np.ndarray, distance: int = 3) -> tuple[np.ndarray, np.ndarray]:
+    """Pairs of distinct hashes at most distance bits apart, with multi-index hashing.
+
+    The 64 bits are split into distance + 1 blocks, of 16 bits at the default distance. Two hashes at most distance
+    bits apart are equal on at least one block, so only hashes sharing a block value are compared. The block size is
+    fixed by the distance, so with uniform hashes the number of comparisons grows as n^2 / 2^block_bits, about 3e7 for
+    a million images at distance 3, and much faster on skewed real hashes, e.g. of many dark frames. A warning is
+    printed when a block has more than MAX_COMPARISONS candidate pairs.
+
+    Args:
+        hashes (np.ndarray): unique 64-bit hashes, uint64
+        distance (int, optional): maximum Hamming distance. Defaults to 3.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: indices of the two hashes of every pair, a pair may appear more than once
+    """
+    n_blocks = distance + 1
+    bounds = np.linspace(0, HASH_BITS, n_blocks + 1).astype(int)
+    first, second = [], []
+
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        block = (hashes >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1)
+
+        sizes = _bucket_sizes(block)
+        comparisons = int(np.sum(sizes * (sizes - 1) // 2))
+        if comparisons > MAX_COMPARISONS:
+            print(
+                Fore.YELLOW + f"Bits {low}-{high} of {len(hashes)} hashes need {comparisons} comparisons, the largest "
+                f"bucket has {sizes.max()} hashes, use a smaller distance for larger blocks"
+            )
+
+        for a, b in _bucket_pairs(block):
+            is_near = hamming_distance(hashes[a], hashes[b]) <= distance
+            first.append(a[is_near])
+            second.append(b[is_near])
+
+    if not first:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    return np.concatenate(first), np.concatenate(second)
+
+
+def connected_components(n: int, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Component label of every node of a graph, the smallest node index of its component.
+
+    Vectorized union-find: the root of every edge end is hooked to the smaller root, and paths are compressed by
+    pointer jumping, until both ends of every edge have the same root.
+    """
+    parent = np.arange(n)
+
+    while True:
+        # Compress every path to its root
+        while not np.array_equal(grand_parent := parent[parent], parent):
+            parent = grand_parent
+
+        root_a, root_b = parent[first], parent[second]
+        differ = root_a != root_b
+        if not differ.any():
+            return parent
+
+        root_a, root_b = root_a[differ], root_b[differ]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+
+
+def find_near_duplicates(
+    table_files: list,
+    dhash_file: str,
+    distance: int = 3,
+    workers: int = None,
+    image_folder: str = None,
+) -> list:
+    """Cluster the images of the data files by dHash, across all files.
+
+    The dHash of every image is cached in dhash_file by md5, so only new images are decoded. Images at most distance
+    bits apart are in the same cluster, and so are the images near to them, transitively.
+
+    Args:
+        table_files (list): processed or combined csv, parquet or feather files
+        dhash_file (str): dHash cache file, tab separated, created if missing
+        distance (int, optional): maximum Hamming distance of near-duplicates, out of 64 bits. Defaults to 3.
+        workers (int, optional): number of processes computing hashes. Defaults to number of cpu.
+        image_folder (str, optional): folder of the images. Defaults to the folder of each data file.
+
+    Returns:
+        list: pd.Series of cluster id of every row of each data file, the md5 of the first image of the cluster in
+            md5 order, missing for rows without a readable image
+    """
+    files = [image_files(table_file, image_folder)["image_file"] for table_file in table_files]
+    unique_files = [file for file in pd.unique(pd.concat(files, ignore_index=True).dropna()) if os.path.exists(file)]
+
+    workers = workers or os.cpu_count() or 1
+    dhashes = load_dhashes(dhash_file)
+
+    with futures.ThreadPoolExecutor(max_workers=4 * workers) as executor:
+        keys = dict(zip(unique_files, bounded_map(executor, image_key, unique_files, 16 * workers)))
+
+    to_hash = [file for file in unique_files if keys[file] not in dhashes]
+
+    with (
+        futures.ProcessPoolExecutor(max_workers=workers) as executor,
+        open(dhash_file, "a", newline="", buffering=1) as f,
+    ):
+        values = bounded_map(executor, dhash, to_hash, 4 * workers)
+        for file, value in zip(to_hash, instrument.progress(values, len(to_hash), "Hash images", "files")):
+            instrument.count(files=1)
+            if value is not None:
+                dhashes[keys[file]] = value
+                f.write(f"{keys[file]}\t{value:016x}\n")
+
+    # Cluster the distinct hashes, identical hashes are always in the same cluster
+    md5s = np.array(sorted({key for key in keys.values() if key in dhashes}), dtype=object)
+    image_hashes = np.array([dhashes[md5] for md5 in md5s], dtype=np.uint64)
+    hashes, inverse = np.unique(image_hashes, return_inverse=True)
+
+    with instrument.stage("cluster"):
+        labels = connected_components(len(hashes), *near_duplicate_pairs(hashes, distance))
+
+    # md5s are sorted, so the first image of every cluster is its smallest md5
+    cluster = labels[inverse]
+    _, first = np.unique(cluster, return_index=True)
+    representative = dict(zip(np.unique(cluster), md5s[first]))
+    cluster_ids = {md5: representative[label] for md5, label in zip(md5s, cluster)}
+
+    file_cluster_ids = {file: cluster_ids.get(key) for file, key in keys.items()}
+    return [file_series.map(file_cluster_ids) for file_series in files]
+
+
+def write_cluster_ids(table_file: str, cluster_ids: pd.Series):
+    """Set the cluster_id column of a data file, replacing the file atomically. csv values are kept as text."""
+    table_file = Path(table_file)
+
+    if TableFormat.from_file(table_file) is TableFormat.csv:
+        data = read_table(table_file, dtype=str, keep_default_na=False)
+    else:
+        data = read_table(table_file)
+
+    data["cluster_id"] = cluster_ids.to_numpy()
+
+    # Keep categorical columns with their categories
+    categories = {
+        column: list(data[column].cat.categories)
+        for column in data.columns
+        if isinstance(data[column].dtype, pd.CategoricalDtype)
+    }
+
+    tmp_file = table_file.with_name(f"{table_file.stem}.tmp{table_file.suffix}")
+    write_table(data, tmp_file, categories)
+    os.replace(tmp_file, table_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find near-duplicate images, and write their cluster_id to data files."
+    )
+
+    # Add arguments
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="Data files, or folders containing processed_data files. (default: %(default)s)",
+        default=["data/03-processed"],
+    )
+    parser.add_argument(
+        "-d",
+        "--distance",
+        type=int,
+        help="Maximum Hamming distance of near-duplicates, out of 64 bits. (default: %(default)s)",
+        default=3,
+    )
+    parser.add_argument(
+        "--dhash_file",
+        type=str,
+        help=f"dHash cache file. (default: {DHASH_FILE} in the first input folder)",
+    )
+    parser.add_argument("--image_folder", type=str, help="Folder of the images, default to the folder of each file")
+    parser.add_argument("-w", "--workers", type=int, help="Number of processes computing hashes")
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    table_files = find_table_files(args.inputs)
+
+    if not table_files:
+        parser.error(Fore.RED + f"No data file found in {args.inputs}")
+
+    dhash_file = args.dhash_file
+    if dhash_file is None:
+        folder = Path(args.inputs[0])
+        dhash_file = (folder if folder.is_dir() else folder.parent) / DHASH_FILE
+
+    with instrument.run(args):
+        try:
+            all_cluster_ids = find_near_duplicates(
+                table_files, dhash_file, args.distance, args.workers, args.image_folder
+            )
+        except ValueError as e:
+            parser.error(Fore.RED + str(e))
+
+        for table_file, cluster_ids in zip(table_files, all_cluster_ids):
+            write_cluster_ids(table_file, cluster_ids)
+
+            sizes = cluster_ids.value_counts()
+            print(
+                f"{table_file}: {len(cluster_ids)} rows, {len(sizes)} clusters, {(sizes > 1).sum()} with near-duplicates"
+            )
+
+        print(Fore.GREEN + f"cluster_id saved, dHash cache saved as {dhash_file}")
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from pathlib import Path
+
+import colorama
+from colorama import Fore
+
+from src.scan_images import find_table_files
+from src.utils import bounded_map, instrument, lazy_import
+from src.utils.shards import ShardWriter
+from src.utils.table_io import encode_table, read_table_chunks, table_columns
+
+futures = lazy_import("concurrent.futures")
+pd = lazy_import("pandas")
+
+colorama.init()
+
+INDEX_FILE = "{prefix}.index.tsv"
+
+
+def read_file(file: str) -> bytes | None:
+    """Content of a file, None if it cannot be read."""
+    try:
+        return Path(file).read_bytes()
+    except OSError:
+        return None
+
+
+def read_sample(sample: tuple) -> tuple:
+    """A sample of iter_samples with the content of its image file, see read_file."""
+    return sample, read_file(sample[1])
+
+
+def image_labels(data: pd.DataFrame) -> dict:
+    """Rows of every image of processed data, mapping new_image_name to a list of row dicts, in order of appearance.
+
+    Values have the types of parquet files, see encode_table, and missing values are None.
+    """
+    data = encode_table(data[data["new_image_name"].astype("string").fillna("") != ""])
+    rows = data.astype(object).where(data.notna(), None).to_dict("records")
+
+    labels = {}
+    for row in rows:
+        labels.setdefault(row["new_image_name"], []).append(row)
+
+    return labels
+
+
+def iter_samples(table_files: list, image_folder: str = None, chunk_size: int = 100_000):
+    """(new_image_name, image file, rows) of every image of processed data files, see image_labels.
+
+    The files are read in chunks of chunk_size rows, and the rows of an image are yielded as soon as the next image
+    starts, so only the rows of one chunk are held. Rows of an image already yielded, which are not next to its other
+    rows, are skipped with a warning.
+    """
+    last, seen, skipped = None, set(), 0
+
+    for table_file in table_files:
+        folder = Path(image_folder) if image_folder is not None else Path(table_file).parent
+
+        for data in read_table_chunks(table_file, chunk_size, dtype=str, keep_default_na=False):
+            for name, rows in image_labels(data).items():
+                if last is not None and name == last[0]:
+                    last[2].extend(rows)  # The image goes on from the previous chunk
+                elif name in seen:
+                    skipped += len(rows)
+                else:
+                    if last is not None:
+                        yield last
+                    seen.add(name)
+                    last = (name, str(folder / name), rows)
+
+    if last is not None:
+        yield last
+
+    if skipped:
+        print(Fore.YELLOW + f"{skipped} rows of images packed before are skipped, combine the data to keep them")
+
+
+def pack_shards(
+    table_files: list,
+    output_folder: str,
+    image_folder: str = None,
+    prefix: str = "data",
+    shard_mb: int = 512,
+    workers: int = None,
+    chunk_size: int = 100_000,
+) -> ShardWriter:
+    """Pack the images of processed data files and their labels into tar shards with an offset index.
+
+    Every image is a sample keyed by its md5, its new_image_name without extension, with the image file as is and a
+    json file of its rows: <md5>.jpg and <md5>.json. An image in consecutive rows is packed once, with all its rows, see
+    iter_samples. The data files are streamed, images are read in a thread pool and packed in the order of the data
+    files. The shard, offset and size of every file are saved in <prefix>.index.tsv, see ShardReader.
+
+    Args:
+        table_files (list): processed, combined or split csv, parquet or feather files
+        output_folder (str): folder of the shards and index
+        image_folder (str, optional): folder of the images. Defaults to the folder of each data file.
+        prefix (str, optional): shard file name prefix, e.g. train. Defaults to "data".
+        shard_mb (int, optional): shard size in MiB to start a new shard. Defaults to 512.
+        workers (int, optional): number of threads reading images. Defaults to thread pool default.
+        chunk_size (int, optional): number of rows read at a time. Defaults to 100_000.
+
+    Returns:
+        ShardWriter: the closed writer, with its shards and number of samples
+    """
+    for table_file in table_files:
+        if "new_image_name" not in table_columns(table_file):
+            raise ValueError(f"{table_file} has no new_image_name column, pack processed data")
+
+    os.makedirs(output_folder, exist_ok=True)
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    missing = 0
+
+    with (
+        futures.ThreadPoolExecutor(max_workers=workers) as executor,
+        ShardWriter(
+            output_folder,
+            prefix,
+            shard_size=None,
+            shard_bytes=shard_mb * 2**20,
+            index_file=INDEX_FILE.format(prefix=prefix),
+        ) as writer,
+    ):
+        samples = bounded_map(executor, read_sample, iter_samples(table_files, image_folder, chunk_size), 4 * workers)
+        for (name, _, rows), content in instrument.progress(samples, desc="Pack images", unit="files"):
+            if content is None:
+                missing += 1
+                continue
+
+            key, ext = os.path.splitext(name)
+            label = json.dumps({"new_image_name": name, "labels": rows}, ensure_ascii=False)
+            writer.write(key, {ext.lstrip(".").lower(): content, "json": label.encode()})
+            instrument.count(files=1, bytes=len(content), rows=len(rows))
+
+    if missing:
+        print(Fore.RED + f"{missing} images cannot be read, run scan_images.py to find them")
+
+    return writer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack processed images and their labels into indexed tar shards.")
+
+    # Add arguments
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="Data files, or folders containing processed_data files. (default: %(default)s)",
+        default=["data/03-processed"],
+    )
+    parser.add_argument("-o", "--output_folder", type=str, help="Output folder of the shards", required=True)
+    parser.add_argument("--image_folder", type=str, help="Folder of the images, default to the folder of each file")
+    parser.add_argument(
+        "-p", "--prefix", type=str, help="Shard file name prefix, e.g. train. (default: %(default)s)", default="data"
+    )
+    parser.add_argument(
+        "--shard_mb", type=int, help="Shard size in MiB to start a new shard. (default: %(default)s)", default=512
+    )
+    parser.add_argument("-w", "--workers", type=int, help="Number of threads reading images")
+    parser.add_argument(
+        "--chunk_size", type=int, help="Number of rows read at a time. (default: %(default)s)", default=100_000
+    )
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    table_files = find_table_files(args.inputs)
+
+    if not table_files:
+        parser.error(Fore.RED + f"No data file found in {args.inputs}")
+
+    with instrument.run(args):
+        try:
+            writer = pack_shards(
+                table_files,
+                args.output_folder,
+                args.image_folder,
+                args.prefix,
+                args.shard_mb,
+                args.workers,
+                args.chunk_size,
+            )
+        except ValueError as e:
+            parser.error(Fore.RED + str(e))
+
+        print(Fore.GREEN + f"{writer.count} images saved in {len(writer.shards)} shards to {args.output_folder}")
+        print(f"Index saved as {writer.index_file}")
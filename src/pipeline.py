@@ -0,0 +1,309 @@
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import colorama
+from colorama import Fore
+
+from src.combine_csv import KeepMode, combine_csv
+from src.interim_to_processed import interim_to_processed
+from src.utils import (
+    CoordinateMode,
+    LabelFormat,
+    StorageMode,
+    instrument,
+    load_yaml_file,
+)
+from src.utils.table_io import TableFormat, config_categories
+from src.yolo_to_csv import yolo_to_csv
+
+colorama.init()
+
+STATE_FILE = ".pipeline_state.json"
+INTERIM_FILE = "interim_data.csv"
+
+
+def file_stats(files) -> list:
+    """(path, size, mtime_ns) of every existing file, sorted by path."""
+    stats = []
+
+    for file in sorted(str(file) for file in files):
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            continue
+        stats.append((file, stat.st_size, stat.st_mtime_ns))
+
+    return stats
+
+
+def fingerprint(files, **params) -> str:
+    """Fingerprint of the content of files, from their size and mtime, and of the parameters of a stage."""
+    key = json.dumps([file_stats(files), params], sort_keys=True, default=str)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def load_state(state_file: Path) -> dict:
+    if not state_file.exists():
+        return {}
+
+    with open(state_file, "r") as f:
+        return json.load(f)
+
+
+def save_state(state_file: Path, state: dict):
+    """Write the state atomically, so an interrupted run keeps the stages completed before it."""
+    tmp_file = state_file.with_name(state_file.name + ".tmp")
+
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+    os.replace(tmp_file, state_file)
+
+
+def run_pipeline(
+    raw_folder: str = "data/01-raw",
+    interim_folder: str = "data/02-interim",
+    processed_folder: str = "data/03-processed",
+    combined_file: str = "data/04-combined/processed_data.csv",
+    config_file: str = "config.yml",
+    sources: list = None,
+    mode: CoordinateMode = CoordinateMode.cxywh,
+    label_format: LabelFormat = LabelFormat.named,
+    workers: int = 1,
+    storage: StorageMode = StorageMode.copy,
+    output_format: TableFormat = TableFormat.csv,
+    filter: bool = False,
+    keep: KeepMode = KeepMode.first,
+    force: bool = False,
+):
+    """Run the non-interactive stages of the reference pipeline for every data source, in one process.
+
+    Every sub-folder of raw_folder is a data source, processed as in notebooks/reference_pipeline.sh:
+
+    1. yolo_to_csv: <raw_folder>/<source> to <interim_folder>/<source>/interim_data.csv
+    2. annotate_image.py is interactive and is not run, annotate the interim csv between two runs
+    3. interim_to_processed: interim csv to <processed_folder>/<source>
+    4. combine_csv: processed data of every source in processed_folder to combined_file, even with sources set
+
+    A stage is skipped when the size and mtime of its input files and its parameters are the same as in the last run,
+    recorded in .pipeline_state.json in processed_folder, and its output exists. Re-running after a change to one
+    source only runs the stages of that source, and the combine.
+
+    An interim csv modified since yolo_to_csv wrote it is annotated, it is never overwritten, even if the raw data
+    changed, unless force is set.
+
+    Args:
+        raw_folder (str, optional): folder of the raw data sources. Defaults to "data/01-raw".
+        interim_folder (str, optional): folder of the interim data. Defaults to "data/02-interim".
+        processed_folder (str, optional): folder of the processed data. Defaults to "data/03-processed".
+        combined_file (str, optional): combined csv, parquet or feather file. Defaults to
+            "data/04-combined/processed_data.csv".
+        config_file (str, optional): path to config file. Defaults to "config.yml".
+        sources (list, optional): names of the data sources to run steps 1 to 3 for. Defaults to all sub-folders of
+            raw_folder.
+        mode (CoordinateMode, optional): coordinate mode of the raw labels. Defaults to cxywh.
+        label_format (LabelFormat, optional): layout of the raw label files. Defaults to named.
+        workers (int, optional): worker processes of yolo_to_csv. Defaults to 1.
+        storage (StorageMode, optional): how interim_to_processed stores new images. Defaults to copy.
+        output_format (TableFormat, optional): format of the processed data files. Defaults to csv.
+        filter (bool, optional): whether to filter license plate in combine. Defaults to False.
+        keep (KeepMode, optional): which row of each license plate to keep with filter. Defaults to first.
+        force (bool, optional): run every stage, overwriting annotated interim csv. Defaults to False.
+    """
+    raw_folder, interim_folder, processed_folder = Path(raw_folder), Path(interim_folder), Path(processed_folder)
+    config = load_yaml_file(config_file)
+
+    if sources is None:
+        sources = sorted(folder.name for folder in raw_folder.iterdir() if folder.is_dir())
+
+    os.makedirs(processed_folder, exist_ok=True)
+    state_file = processed_folder / STATE_FILE
+    state = load_state(state_file) if not force else {}
+
+    for source in sources:
+        # Step 1: Convert yolo (txt) dataset to csv
+        key = f"yolo_to_csv:{source}"
+        interim_file = interim_folder / source / INTERIM_FILE
+        label_files = (raw_folder / source).glob("**/*.txt")
+        input_fingerprint = fingerprint(
+            label_files, mode=mode.name, label_format=label_format.name, header=config["yolo_to_csv_header"]
+        )
+        last = state.get(key, {})
+        is_annotated = interim_file.exists() and fingerprint([interim_file]) != last.get("output")
+
+        if is_annotated and not force:
+            if input_fingerprint != last.get("input"):
+                print(Fore.YELLOW + f"{interim_file} is annotated, not overwritten with changed raw data, use --force")
+            else:
+                print(Fore.BLUE + f"Skip {key}, annotated")
+        elif input_fingerprint == last.get("input") and interim_file.exists():
+            print(Fore.BLUE + f"Skip {key}, unchanged")
+        else:
+            print(Fore.GREEN + f"Run {key}")
+            os.makedirs(interim_file.parent, exist_ok=True)
+            with instrument.stage(key):
+                yolo_to_csv(
+                    raw_folder / source,
+                    interim_file,
+                    mode=mode,
+                    csv_header=config["yolo_to_csv_header"],
+                    workers=workers,
+                    label_format=label_format,
+                )
+            state[key] = {"input": input_fingerprint, "output": fingerprint([interim_file])}
+            save_state(state_file, state)
+
+        # Step 2: Annotate or verify the image, interactive
+        if not interim_file.exists():
+            continue
+
+        if Path(f"{interim_file}.journal").exists():
+            print(Fore.YELLOW + f"Skip interim_to_processed:{source}, {interim_file} has unsaved annotations")
+            continue
+
+        # Step 3: Process from interim (verified) data to processed data
+        key = f"interim_to_processed:{source}"
+        output_folder = processed_folder / source
+        processed_file = output_folder / f"processed_data{output_format.suffix}"
+        input_fingerprint = fingerprint(
+            [interim_file, config_file], storage=storage.name, output_format=output_format.name
+        )
+
+        if input_fingerprint == state.get(key, {}).get("input") and processed_file.exists():
+            print(Fore.BLUE + f"Skip {key}, unchanged")
+        else:
+            print(Fore.GREEN + f"Run {key}")
+            with instrument.stage(key):
+                interim_to_processed(
+                    interim_file, output_folder, config_file, storage=storage, output_format=output_format
+                )
+            state[key] = {"input": input_fingerprint}
+            save_state(state_file, state)
+
+    # Step 4: Combine all processed data, of every source in processed_folder and not only the sources run
+    key = "combine_csv"
+    processed_files = sorted(processed_folder.glob(f"*/processed_data{output_format.suffix}"))
+    input_fingerprint = fingerprint(
+        processed_files, filter=filter, keep=keep.name, header=config["processed_data_header"]
+    )
+
+    if input_fingerprint == state.get(key, {}).get("input") and Path(combined_file).exists():
+        print(Fore.BLUE + f"Skip {key}, unchanged")
+    elif processed_files:
+        print(Fore.GREEN + f"Run {key}")
+        os.makedirs(Path(combined_file).parent, exist_ok=True)
+        with instrument.stage(key):
+            combine_csv(
+                processed_files,
+                combined_file,
+                filter,
+                config["processed_data_header"],
+                keep=keep,
+                categories=config_categories(config),
+            )
+        state[key] = {"input": input_fingerprint}
+        save_state(state_file, state)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the reference pipeline for every data source, skip unchanged.")
+
+    # Add arguments
+    parser.add_argument("-c", "--config", type=str, help="Config file path", default="config.yml")
+    parser.add_argument(
+        "-s",
+        "--sources",
+        type=str,
+        nargs="+",
+        help="Data sources to convert and process, default to all. Every processed source is combined",
+    )
+    parser.add_argument("--raw_folder", type=str, help="(default: %(default)s)", default="data/01-raw")
+    parser.add_argument("--interim_folder", type=str, help="(default: %(default)s)", default="data/02-interim")
+    parser.add_argument("--processed_folder", type=str, help="(default: %(default)s)", default="data/03-processed")
+    parser.add_argument(
+        "-o",
+        "--combined_file",
+        type=str,
+        help="Combined csv, parquet or feather file. (default: %(default)s)",
+        default="data/04-combined/processed_data.csv",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        type=str,
+        help="Raw label coordinate mode. (default: %(default)s)",
+        choices=CoordinateMode.all_option(),
+        default=CoordinateMode.default.name,
+    )
+    parser.add_argument(
+        "--label_format",
+        type=str,
+        help="Raw label file layout. (default: %(default)s)",
+        choices=LabelFormat.all_option(),
+        default=LabelFormat.default.name,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of worker processes for parsing label files. (default: %(default)s)",
+        default=1,
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        help="How to store new images. (default: %(default)s)",
+        choices=StorageMode.all_option(),
+        default=StorageMode.default.name,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        help="Format of the processed data files. (default: %(default)s)",
+        choices=TableFormat.all_option(),
+        default=TableFormat.default.name,
+    )
+    parser.add_argument("--filter_lp", action="store_true", help="Whether to filter license plate")
+    parser.add_argument(
+        "--keep",
+        type=str,
+        help="Which row of each license plate to keep with --filter_lp. (default: %(default)s)",
+        choices=KeepMode.all_option(),
+        default=KeepMode.default.name,
+    )
+    parser.add_argument("--force", action="store_true", help="Run every stage, overwrite annotated interim csv")
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    # Check that combined file is a supported table format
+    try:
+        TableFormat.from_file(args.combined_file)
+    except ValueError as e:
+        parser.error(Fore.RED + str(e))
+
+    if not os.path.isdir(args.raw_folder):
+        parser.error(Fore.RED + f"Folder {args.raw_folder} NOT FOUND")
+
+    with instrument.run(args):
+        run_pipeline(
+            args.raw_folder,
+            args.interim_folder,
+            args.processed_folder,
+            args.combined_file,
+            args.config,
+            args.sources,
+            CoordinateMode[args.mode],
+            LabelFormat[args.label_format],
+            args.workers,
+            StorageMode[args.storage],
+            TableFormat[args.format],
+            args.filter_lp,
+            KeepMode[args.keep],
+            args.force,
+        )
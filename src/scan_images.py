@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import os
+import re
+from functools import partial
+from pathlib import Path
+from typing import NamedTuple
+
+import colorama
+from colorama import Fore
+
+from src.utils import bounded_map, generate_md5_file, instrument, lazy_import
+from src.utils.table_io import TABLE_SUFFIXES, read_table, table_columns, write_table
+
+futures = lazy_import("concurrent.futures")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+Image = lazy_import("PIL.Image")
+
+colorama.init()
+
+INDEX_FILE = "image_index.tsv"
+INDEX_HEADER = ["md5", "width", "height", "format", "orientation", "verified", "error"]
+MD5_NAME = re.compile(r"^[0-9a-f]{32}$")
+EXIF_ORIENTATION = 0x0112
+STATUSES = ["missing", "corrupt", "out_of_bounds", "no_box"]
+
+
+class ImageInfo(NamedTuple):
+    width: int
+    height: int
+    format: str
+    orientation: int  # EXIF orientation, 1 if none
+    verified: bool  # whether the whole image was decoded, else only the header was read
+    error: str  # empty if the image could be read
+
+
+def read_image_info(image_file: str, decode: bool = False) -> ImageInfo:
+    """Read the size, format and EXIF orientation of an image from its header, without decoding the pixels.
+
+    Args:
+        image_file (str, path): path to the image
+        decode (bool, optional): also decode the whole image, to find truncated files. Defaults to False.
+
+    Returns:
+        ImageInfo: image metadata, with the error message if the image cannot be read
+    """
+    try:
+        with Image.open(image_file) as img:
+            orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+            info = ImageInfo(img.width, img.height, img.format, int(orientation), decode, "")
+
+            if decode:
+                img.load()
+
+            return info
+    except Exception as e:
+        return ImageInfo(0, 0, "", 0, decode, f"{type(e).__name__}: {e}".replace("\t", " ").replace("\n", " "))
+
+
+def image_key(image_file: str) -> str:
+    """md5 of an image, from its file name for processed images named by generate_md5_file, else by hashing it."""
+    stem = Path(image_file).stem
+    return stem if MD5_NAME.match(stem) else generate_md5_file(image_file)
+
+
+def load_index(index_file: str) -> dict:
+    """Load the image index, mapping md5 to ImageInfo. The incomplete last line of an interrupted scan is ignored."""
+    if not os.path.exists(index_file):
+        return {}
+
+    with open(index_file, "r", newline="") as f:
+        rows = [row for row in csv.reader(f, delimiter="\t") if len(row) == len(INDEX_HEADER)]
+
+    return {
+        row[0]: ImageInfo(int(row[1]), int(row[2]), row[3], int(row[4]), row[5] == "1", row[6])
+        for row in rows
+        if row[0] != INDEX_HEADER[0]
+    }
+
+
+def image_files(table_file: str, image_folder: str = None, columns: list = None) -> pd.DataFrame:
+    """Image file and plate box of every row of a processed or interim data file.
+
+    Processed images are new_image_name in image_folder, interim images are old_image_name in old_image_path.
+
+    Args:
+        table_file (str, path): processed or interim csv, parquet or feather file
+        image_folder (str, optional): folder of the processed images. Defaults to the folder of table_file.
+        columns (list, optional): other columns to return as is. Defaults to none.
+
+    Returns:
+        pd.DataFrame: image_file, None if the row has no image name, x1, y1, x2, y2 as float if the data has a box,
+            and the other columns
+    """
+    table_file = Path(table_file)
+    image_folder = Path(image_folder) if image_folder is not None else table_file.parent
+    table_column_names = table_columns(table_file)
+    box_columns = [column for column in ("x1", "y1", "x2", "y2") if column in table_column_names]
+    columns = columns or []
+
+    if "new_image_name" in table_column_names:
+        data = read_table(table_file, columns=["new_image_name"] + box_columns + columns)
+        names = data["new_image_name"].astype(object)
+        files = [str(image_folder / name) if isinstance(name, str) else None for name in names]
+    elif {"old_image_path", "old_image_name"}.issubset(table_column_names):
+        data = read_table(table_file, columns=["old_image_path", "old_image_name"] + box_columns + columns)
+        files = [os.path.join(path, name) for path, name in zip(data["old_image_path"], data["old_image_name"])]
+    else:
+        raise ValueError(f"{table_file} has no new_image_name, or old_image_path and old_image_name column")
+
+    result = pd.DataFrame({"image_file": pd.Series(files, dtype=object)})
+
+    if len(box_columns) == 4:
+        for column in box_columns:
+            result[column] = pd.to_numeric(data[column], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+    for column in columns:
+        result[column] = data[column].to_numpy()
+
+    return result
+
+
+def scan_images(
+    table_files: list,
+    index_file: str,
+    workers: int = None,
+    decode: bool = False,
+) -> pd.DataFrame:
+    """Check that every image referenced by the data files exists, can be read, and contains the plate box.
+
+    Every image is looked up in the index by md5. Images not in the index yet are read in a thread pool, header only
+    unless decode, and appended to the index as soon as they are read. A re-scan only reads new images, or images
+    only read by header when decode is set.
+
+    Args:
+        table_files (list): processed or interim csv, parquet or feather files
+        index_file (str): image index file, tab separated, created if missing
+        workers (int, optional): number of threads reading images. Defaults to thread pool default.
+        decode (bool, optional): decode the whole image, to find truncated files. Defaults to False.
+
+    Returns:
+        pd.DataFrame: one row per data row with a problem, with its table file, row, image file, status (missing,
+            corrupt, out_of_bounds or no_box if the row has no box), stored image size and error message
+    """
+    data = []
+
+    for table_file in table_files:
+        files = image_files(table_file)
+        files.insert(0, "row", np.arange(len(files)))
+        files.insert(0, "table_file", str(table_file))
+        data.append(files)
+
+    data = pd.concat(data, ignore_index=True) if data else pd.DataFrame(columns=["table_file", "row", "image_file"])
+
+    # Each image is read once, even if it appears in many rows
+    unique_files = [file for file in data["image_file"].dropna().unique() if os.path.exists(file)]
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    index = load_index(index_file)
+    infos = {}
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        keys = dict(zip(unique_files, bounded_map(executor, image_key, unique_files, 4 * workers)))
+        to_read = [
+            file for file in unique_files if keys[file] not in index or (decode and not index[keys[file]].verified)
+        ]
+
+        is_new = not os.path.exists(index_file) or os.path.getsize(index_file) == 0
+        with open(index_file, "a", newline="", buffering=1) as f:
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+
+            if is_new:
+                writer.writerow(INDEX_HEADER)
+
+            read_info = partial(read_image_info, decode=decode)
+            infos_read = bounded_map(executor, read_info, to_read, 4 * workers)
+            for file, info in zip(to_read, instrument.progress(infos_read, len(to_read), "Read images", "files")):
+                index[keys[file]] = info
+                instrument.count(files=1)
+                writer.writerow(
+                    (keys[file], info.width, info.height, info.format, info.orientation, int(info.verified), info.error)
+                )
+
+    for file, key in keys.items():
+        infos[file] = index[key]
+
+    # Flag every row in one pass
+    info = data["image_file"].map(infos)
+    width = info.map(lambda i: i.width, na_action="ignore").to_numpy(dtype=float, na_value=np.nan)
+    height = info.map(lambda i: i.height, na_action="ignore").to_numpy(dtype=float, na_value=np.nan)
+    error = info.map(lambda i: i.error, na_action="ignore").fillna("")
+
+    # Boxes are in stored pixels, as cropped by export_crops and the annotator, so the EXIF orientation is ignored
+    status = np.full(len(data), "", dtype=object)
+
+    if {"x1", "y1", "x2", "y2"}.issubset(data.columns):
+        x1, y1, x2, y2 = (data[column].to_numpy() for column in ("x1", "y1", "x2", "y2"))
+        with np.errstate(invalid="ignore"):
+            in_bounds = (0 <= x1) & (x1 < x2) & (x2 <= width) & (0 <= y1) & (y1 < y2) & (y2 <= height)
+        status[~in_bounds] = "out_of_bounds"
+        status[np.isnan(np.stack([x1, y1, x2, y2])).all(axis=0)] = "no_box"
+
+    status[(error != "").to_numpy()] = "corrupt"
+    status[info.isna().to_numpy()] = "missing"
+
+    report = data[["table_file", "row", "image_file"]].assign(status=status, width=width, height=height, error=error)
+    return report[status != ""].reset_index(drop=True)
+
+
+def find_table_files(inputs: list) -> list:
+    """Table files given directly, and processed_data files found in the given folders."""
+    table_files = []
+
+    for input in inputs:
+        if Path(input).suffix.lower() in TABLE_SUFFIXES:
+            table_files.append(Path(input))
+        else:
+            table_files.extend(sorted(Path(input).glob("**/processed_data.*")))
+
+    return [file for file in table_files if file.suffix.lower() in TABLE_SUFFIXES]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check images referenced by data files, and index their metadata.")
+
+    # Add arguments
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="Data files, or folders containing processed_data files. (default: %(default)s)",
+        default=["data/03-processed"],
+    )
+    parser.add_argument(
+        "-i",
+        "--index",
+        type=str,
+        help=f"Image index file. (default: {INDEX_FILE} in the first input folder)",
+    )
+    parser.add_argument("-o", "--output_file", type=str, help="Save the flagged rows to a csv, parquet or feather file")
+    parser.add_argument("-w", "--workers", type=int, help="Number of threads reading images")
+    parser.add_argument("--decode", action="store_true", help="Decode the whole images, to find truncated files")
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    table_files = find_table_files(args.inputs)
+
+    if not table_files:
+        parser.error(Fore.RED + f"No data file found in {args.inputs}")
+
+    index_file = args.index
+    if index_file is None:
+        folder = Path(args.inputs[0])
+        index_file = (folder if folder.is_dir() else folder.parent) / INDEX_FILE
+
+    with instrument.run(args):
+        try:
+            report = scan_images(table_files, index_file, args.workers, args.decode)
+        except ValueError as e:
+            parser.error(Fore.RED + str(e))
+
+        counts = report["status"].value_counts()
+        for status in STATUSES:
+            color = (Fore.YELLOW if status == "no_box" else Fore.RED) if counts.get(status, 0) else Fore.GREEN
+            print(color + f"{status}: {counts.get(status, 0)} rows")
+
+        print(f"Index saved as {index_file}")
+
+        if args.output_file:
+            write_table(report, args.output_file)
+            print(f"Flagged rows saved as {args.output_file}")
@@ -0,0 +1,361 @@
+from __future__ import annotations
+
+import argparse
+import os
+from pathlib import Path
+
+import colorama
+from colorama import Fore
+
+from src.combine_csv import UNREADABLE_LP
+from src.near_duplicates import connected_components
+from src.utils import instrument, lazy_import, load_yaml_file
+from src.utils.table_io import (
+    CATEGORY_CONFIG,
+    TableFormat,
+    TableWriter,
+    config_categories,
+    read_table_chunks,
+    table_columns,
+    write_table,
+)
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+colorama.init()
+
+SPLITS = ["train", "val", "test"]
+GROUP_COLUMNS = ["lp", "cluster_id", "source"]
+STRATA_COLUMNS = list(CATEGORY_CONFIG)
+
+
+def key_hashes(values: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """64-bit hash of every value, stable across runs, and whether the value is set."""
+    text = values.astype(object).where(values.notna(), "").astype(str).to_numpy(dtype=object)
+    return pd.util.hash_array(text), text != ""
+
+
+def _same_key_edges(hashes: np.ndarray, is_set: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Edges between consecutive rows of the same key, in key order, which connect all rows sharing a key."""
+    rows = np.flatnonzero(is_set)
+    rows = rows[np.argsort(hashes[rows], kind="stable")]
+    is_same = hashes[rows[1:]] == hashes[rows[:-1]]
+    return rows[:-1][is_same], rows[1:][is_same]
+
+
+def _stratified_splits(
+    group_key: np.ndarray, group_rows: np.ndarray, group_stratum: np.ndarray, ratios: list, seed: int
+) -> np.ndarray:
+    """Split of every group, from the quantile of its key among the rows of its stratum.
+
+    In every stratum the groups are ordered by key, and a group takes the split of the middle of its rows in the
+    stratum, so each stratum meets the ratios to within one group. The quantiles of a stratum are shifted by a hash of
+    the stratum, so that strata of a single group are spread over the splits too.
+    """
+    order = np.lexsort((group_key, group_stratum))
+    stratum, rows = group_stratum[order], group_rows[order].astype(float)
+
+    is_start = np.r_[True, stratum[1:] != stratum[:-1]]
+    starts = np.flatnonzero(is_start)
+    ends = np.r_[starts[1:], len(order)]
+
+    cumulative = np.cumsum(rows)
+    before = np.r_[0.0, cumulative][starts]  # rows of the previous strata
+    stratum_index = np.cumsum(is_start) - 1
+    totals = (np.r_[0.0, cumulative][ends] - before)[stratum_index]
+
+    offset = pd.util.hash_array(stratum + np.uint64(seed)).astype(float) / 2.0**64
+    position = ((cumulative - rows / 2 - before[stratum_index]) / totals + offset) % 1.0
+
+    splits = np.empty(len(order), dtype=np.uint8)
+    splits[order] = np.searchsorted(np.cumsum(ratios)[:-1] / np.sum(ratios), position, side="right")
+    return splits
+
+
+def assign_splits(
+    table_file: str,
+    ratios: list,
+    group_columns: list = None,
+    chunk_size: int = 100_000,
+    seed: int = 0,
+    strata_columns: list = None,
+) -> np.ndarray:
+    """Split of every row of a data file, without any two splits sharing an image or a group value.
+
+    Rows sharing an image, a license plate or a value of any other group column are in the same group, transitively.
+    The key of a group is the smallest hash of its values of the first group column it has a value of, or of its image
+    names if it has none.
+
+    With strata columns, a group is in the stratum of the values of its first row, and in every stratum the groups are
+    split by the quantiles of their keys, so every stratum meets the ratios; adding rows only moves groups at the
+    quantile bounds of their stratum. Without strata columns, the split of a group only depends on its key: adding
+    images of plates and clusters already in the data does not move any row. Only the image name, group and strata
+    columns are read.
+
+    Args:
+        table_file (str): combined csv, parquet or feather file
+        ratios (list): share of the rows in train, val and test
+        group_columns (list, optional): columns whose rows with the same value are kept in the same split, used if in
+            the file. Defaults to GROUP_COLUMNS.
+        chunk_size (int, optional): number of rows read at a time. Defaults to 100_000.
+        seed (int, optional): changes the split of every group. Defaults to 0.
+        strata_columns (list, optional): columns whose combinations of values are split to the ratios, used if in the
+            file, empty for none. Defaults to STRATA_COLUMNS.
+
+    Returns:
+        np.ndarray: index in SPLITS of the split of every row, uint8
+    """
+    columns = table_columns(table_file)
+    image_columns = [column for column in ("new_image_name", "old_image_name") if column in columns]
+    group_columns = [column for column in group_columns or GROUP_COLUMNS if column in columns]
+    strata_columns = STRATA_COLUMNS if strata_columns is None else strata_columns
+    strata_columns = [column for column in strata_columns if column in columns]
+
+    if not image_columns:
+        raise ValueError(f"{table_file} has no new_image_name or old_image_name column")
+
+    image_hash, stratum_hash, key_chunks = [], [], {column: [] for column in group_columns}
+    read_columns = list(dict.fromkeys(image_columns + group_columns + strata_columns))
+
+    for data in read_table_chunks(table_file, chunk_size, read_columns, dtype=str):
+        # Rows without new image name, not copied to processed yet, are grouped by their old image name
+        names = data[image_columns[0]]
+        for column in image_columns[1:]:
+            names = names.fillna(data[column])
+        image_hash.append(key_hashes(names)[0])
+
+        for column in group_columns:
+            values = data[column]
+            if column == "lp":
+                values = values.mask(values == UNREADABLE_LP)  # Every unreadable plate is a different plate
+            key_chunks[column].append(key_hashes(values))
+
+        if strata_columns:
+            stratum_hash.append(pd.util.hash_pandas_object(data[strata_columns], index=False).to_numpy())
+
+    image_hash = np.concatenate(image_hash) if image_hash else np.empty(0, dtype=np.uint64)
+    n_rows = len(image_hash)
+
+    keys = [tuple(np.concatenate(parts) for parts in zip(*chunks)) for chunks in key_chunks.values() if chunks]
+
+    first, second = _same_key_edges(image_hash, np.ones(n_rows, dtype=bool))
+    first, second = [first], [second]
+
+    for hashes, is_set in keys:
+        a, b = _same_key_edges(hashes, is_set)
+        first.append(a)
+        second.append(b)
+
+    labels = connected_components(n_rows, np.concatenate(first), np.concatenate(second))
+
+    sizes = np.bincount(labels, minlength=1)
+    print(f"{table_file}: {n_rows} rows in {np.count_nonzero(sizes)} groups, the largest has {sizes.max()} rows")
+    if sizes.max() > min(ratio for ratio in ratios if ratio > 0) / np.sum(ratios) * n_rows:
+        print(Fore.YELLOW + "The largest group is larger than a split, use fewer group columns to meet the ratios")
+
+    # Key of a group: the smallest hash of its first group column with a value, then of its image names. It is rehashed,
+    # so large groups are not biased to small values
+    unset = np.iinfo(np.uint64).max
+    group_hash = np.full(n_rows, unset, dtype=np.uint64)
+
+    for hashes, is_set in keys + [(image_hash, np.ones(n_rows, dtype=bool))]:
+        column_hash = np.full(n_rows, unset, dtype=np.uint64)
+        np.minimum.at(column_hash, labels[is_set], hashes[is_set])
+        group_hash = np.where(group_hash == unset, column_hash, group_hash)
+
+    group_hash = pd.util.hash_array(group_hash + np.uint64(seed))
+
+    if strata_columns and n_rows:
+        first_row = np.full(n_rows, n_rows, dtype=np.int64)
+        np.minimum.at(first_row, labels, np.arange(n_rows))
+        groups = np.flatnonzero(sizes)
+        group_splits = np.zeros(n_rows, dtype=np.uint8)
+        group_splits[groups] = _stratified_splits(
+            group_hash[groups], sizes[groups], np.concatenate(stratum_hash)[first_row[groups]], ratios, seed
+        )
+        return group_splits[labels]
+
+    bounds = np.cumsum(ratios) / np.sum(ratios) * 2.0**64
+    return np.searchsorted(bounds[:-1], group_hash[labels].astype(float), side="right").astype(np.uint8)
+
+
+def split_dataset(
+    table_file: str,
+    output_folder: str,
+    ratios: list = None,
+    group_columns: list = None,
+    output_format: TableFormat = None,
+    chunk_size: int = 100_000,
+    seed: int = 0,
+    categories: dict = None,
+    strata_columns: list = None,
+) -> pd.DataFrame:
+    """Split a combined data file into train, val and test files, see assign_splits.
+
+    The data is streamed to <output_folder>/train, val and test in chunks of chunk_size rows, in the order of the input,
+    and csv values are copied as text.
+
+    Args:
+        table_file (str): combined csv, parquet or feather file
+        output_folder (str): folder of the split files
+        ratios (list, optional): share of the rows in train, val and test. Defaults to [0.8, 0.1, 0.1].
+        group_columns (list, optional): columns kept in the same split, see assign_splits. Defaults to GROUP_COLUMNS.
+        output_format (TableFormat, optional): format of the split files. Defaults to the format of table_file.
+        chunk_size (int, optional): number of rows read at a time. Defaults to 100_000.
+        seed (int, optional): changes the split of every group. Defaults to 0.
+        categories (dict, optional): allowed values of categorical columns of parquet and feather output, see
+            config_categories. Defaults to none.
+        strata_columns (list, optional): columns split to the ratios, see assign_splits. Defaults to STRATA_COLUMNS.
+
+    Returns:
+        pd.DataFrame: number of rows of every stratum in every split, one row per column and value of STRATA_COLUMNS
+            and one "all" row
+    """
+    ratios = ratios or [0.8, 0.1, 0.1]
+    output_format = output_format or TableFormat.from_file(table_file)
+    with instrument.stage("assign_splits"):
+        splits = assign_splits(table_file, ratios, group_columns, chunk_size, seed, strata_columns)
+
+    columns = table_columns(table_file)
+    strata_columns = [column for column in STRATA_COLUMNS if column in columns]
+    counts = []
+    offset = 0
+
+    os.makedirs(output_folder, exist_ok=True)
+    writers = [
+        TableWriter(Path(output_folder) / f"{split}{output_format.suffix}", columns, categories) for split in SPLITS
+    ]
+
+    progress = instrument.Progress(len(splits), "Write splits", "rows")
+
+    try:
+        for data in read_table_chunks(table_file, chunk_size, dtype=str, keep_default_na=False):
+            instrument.count(rows=len(data))
+            progress.update(len(data))
+            end = offset + len(data)
+            chunk_splits, offset = splits[offset:end], end
+
+            for i, writer in enumerate(writers):
+                writer.write(data[chunk_splits == i])
+
+            strata = data[strata_columns].astype(object).where(data[strata_columns].notna(), "")
+            strata = strata.assign(all="all", split=np.asarray(SPLITS)[chunk_splits])
+            for column in strata_columns + ["all"]:
+                counts.append(strata.groupby([column, "split"]).size().rename_axis(["value", "split"]).to_frame("rows"))
+                counts[-1]["column"] = column
+    finally:
+        progress.close()
+        for writer in writers:
+            writer.close()
+
+    if not counts:
+        return pd.DataFrame(columns=["column", "value"] + SPLITS)
+
+    report = pd.concat(counts).reset_index().groupby(["column", "value", "split"])["rows"].sum()
+    report = report.unstack("split").reindex(columns=SPLITS).fillna(0).astype(int).reset_index()
+    report.columns.name = None
+    return report
+
+
+def print_report(report: pd.DataFrame, ratios: list, min_rows: int = 100):
+    """Print the split sizes, and the strata of at least min_rows rows whose split shares are off or empty."""
+    shares = np.asarray(ratios) / np.sum(ratios)
+    rows = report[SPLITS].to_numpy()
+    total = rows.sum(axis=1, keepdims=True)
+    deviation = np.abs(rows / np.maximum(total, 1) - shares).max(axis=1)
+
+    for split, size in zip(SPLITS, rows[report["column"] == "all"].sum(axis=0)):
+        print(f"{split}: {size} rows")
+
+    is_off = (total[:, 0] >= min_rows) & (report["column"] != "all").to_numpy()
+    is_off &= (deviation > 0.05) | ((rows == 0) & (shares > 0)).any(axis=1)
+
+    for (_, row), dev in zip(report[is_off].iterrows(), deviation[is_off]):
+        sizes = ", ".join(f"{split} {row[split]}" for split in SPLITS)
+        print(Fore.YELLOW + f"{row['column']}={row['value']}: {sizes}, share off by {dev:.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split combined data into train, val and test without sharing images or plates across splits."
+    )
+
+    # Add arguments
+    parser.add_argument("table_file", type=str, help="Combined csv, parquet or feather file")
+    parser.add_argument("-o", "--output_folder", type=str, help="Output folder of the split files", required=True)
+    parser.add_argument(
+        "-r",
+        "--ratios",
+        type=float,
+        nargs=3,
+        metavar=("TRAIN", "VAL", "TEST"),
+        help="Share of the rows in every split. (default: %(default)s)",
+        default=[0.8, 0.1, 0.1],
+    )
+    parser.add_argument(
+        "-g",
+        "--group",
+        type=str,
+        nargs="*",
+        help="Columns whose rows with the same value are in the same split, images always are. (default: %(default)s)",
+        default=GROUP_COLUMNS,
+    )
+    parser.add_argument(
+        "--strata",
+        type=str,
+        nargs="*",
+        help="Columns whose combinations of values are split to the ratios, none for a split that only depends on "
+        "every group. (default: %(default)s)",
+        default=STRATA_COLUMNS,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        help="Format of the split files, default to the format of table_file",
+        choices=TableFormat.all_option(),
+    )
+    parser.add_argument("-c", "--config", type=str, help="Config file path, to encode categorical columns")
+    parser.add_argument("--seed", type=int, help="Change the split of every group. (default: %(default)s)", default=0)
+    parser.add_argument(
+        "--chunk_size", type=int, help="Number of rows read at a time. (default: %(default)s)", default=100_000
+    )
+    parser.add_argument("--report_file", type=str, help="Save the rows of every stratum in every split to a file")
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if min(args.ratios) < 0 or sum(args.ratios) <= 0:
+        parser.error(Fore.RED + f"Invalid ratios {args.ratios}, must be positive")
+
+    try:
+        TableFormat.from_file(args.table_file)
+    except ValueError as e:
+        parser.error(Fore.RED + str(e))
+
+    with instrument.run(args):
+        config = load_yaml_file(args.config) if args.config else {}
+
+        try:
+            report = split_dataset(
+                args.table_file,
+                args.output_folder,
+                args.ratios,
+                args.group,
+                TableFormat[args.format] if args.format else None,
+                args.chunk_size,
+                args.seed,
+                config_categories(config),
+                args.strata,
+            )
+        except ValueError as e:
+            parser.error(Fore.RED + str(e))
+
+        print_report(report, args.ratios)
+
+        if args.report_file:
+            write_table(report, args.report_file)
+            print(f"Stratum report saved as {args.report_file}")
+        print(Fore.GREEN + f"Splits saved in {args.output_folder}")
@@ -1,8 +1,27 @@
-import hashlib
+from __future__ import annotations
+
+import os
 from enum import Enum
+from pathlib import Path
+from typing import NamedTuple
+
+from src.utils.hash_cache import HashCache, get_hash_cache  # noqa: F401
+from src.utils.lazy import lazy_import
+
+hashlib = lazy_import("hashlib")
+pickle = lazy_import("pickle")
+shutil = lazy_import("shutil")
+tempfile = lazy_import("tempfile")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+yaml = lazy_import("yaml")
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-import numpy as np
-import yaml
+FICLONE = 0x40049409  # Linux ioctl to clone a file (reflink)
 
 
 class CoordinateMode(Enum):
@@ -16,33 +35,323 @@ class CoordinateMode(Enum):
         return [mode.name for mode in list(CoordinateMode)]
 
 
-def generate_md5_file(filename: str) -> str:
+class LabelFormat(Enum):
+    named = 1  # image name, x, y, w, h, attributes... (Default for this repo)
+    yolo = 2  # class id, x, y, w, h, attributes... (Standard YOLO, image name from label file name)
+    default = named
+
+    @classmethod
+    def all_option(cls):
+        return [fmt.name for fmt in list(LabelFormat)]
+
+
+class StorageMode(Enum):
+    copy = 1  # copy the bytes (Default)
+    hardlink = 2  # hardlink to the source file, fallback to copy
+    reflink = 3  # copy-on-write clone, fallback to copy
+    auto = 4  # reflink, else hardlink, else copy
+    default = copy
+
+    @classmethod
+    def all_option(cls):
+        return [mode.name for mode in list(StorageMode)]
+
+
+class LabelFields(NamedTuple):
+    fields: np.ndarray  # (N, F) object array of the fields of each box, None where a line has fewer fields
+    file_index: np.ndarray  # (N,) index of the label file each box comes from
+
+
+def parse_label_files(files: list) -> LabelFields:
+    """Parse label files with one box per line into a columnar array.
+
+    Fields are separated by tabs, or by spaces when the file has no tab.
+
+    Args:
+        files (list): list of path to label files
+
+    Returns:
+        LabelFields: fields of every box across all files, and the file each box belongs to
+    """
+    lines = []
+    counts = np.zeros(len(files), dtype=int)
+
+    for i, file in enumerate(files):
+        with open(file, "r") as f:
+            text = f.read()
+
+        file_lines = [line.strip() for line in text.splitlines() if line.strip()]
+
+        # Normalize space separated file to tab separated, so all lines split in one vectorized call
+        if "\t" not in text:
+            file_lines = ["\t".join(line.split()) for line in file_lines]
+
+        lines.extend(file_lines)
+        counts[i] = len(file_lines)
+
+    if lines:
+        fields = pd.Series(lines, dtype=object).str.split("\t", expand=True).to_numpy(dtype=object)
+    else:
+        fields = np.empty((0, 0), dtype=object)
+
+    return LabelFields(fields, np.repeat(np.arange(len(files)), counts))
+
+
+CHUNK_SIZE = 1024 * 1024  # 1 MiB read size for hashing and copying
+PART_SUFFIX = ".part"  # Temporary file of copy_file_md5, renamed once complete
+
+
+def generate_md5_file(filename: str, chunk_size: int = CHUNK_SIZE, use_cache: bool = True) -> str:
     """Generate md5 hash of the file.
 
+    The hash is looked up in, and saved to, the shared hash cache from get_hash_cache, so an unchanged file is only
+    read once across runs.
+
     Args:
         filename(str, path): path to the file
+        chunk_size(int): number of bytes read at a time
+        use_cache(bool): whether to use the shared hash cache
 
     Returns:
         md5hash(str): string of the md5 hash
     """
+    cache = get_hash_cache() if use_cache else None
+
+    if cache is not None:
+        stat = os.stat(filename)
+        if md5 := cache.get(filename, stat):
+            return md5
+
+    md5hash = hashlib.md5()
 
     with open(filename, "rb") as f:
-        md5hash = hashlib.md5(f.read())
+        while chunk := f.read(chunk_size):
+            md5hash.update(chunk)
+
+    if cache is not None:
+        cache.put(filename, md5hash.hexdigest(), stat)
 
     return md5hash.hexdigest()
 
 
-def load_yaml_file(file: str) -> dict:
-    """Load yaml file for config.
+def _reflink(src: str, dst: str):
+    """Create dst as a copy-on-write clone of src, raise OSError if the filesystem does not support it."""
+    if fcntl is None:
+        raise OSError("reflink is not supported on this platform")
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _link_file(src: str, dst: str, storage: "StorageMode"):
+    """Create dst from src with the given storage mode, falling back to a byte copy when linking fails."""
+    if storage in (StorageMode.reflink, StorageMode.auto):
+        try:
+            return _reflink(src, dst)
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+
+    if storage in (StorageMode.hardlink, StorageMode.auto):
+        try:
+            return os.link(src, dst)
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+
+
+def copy_file_md5(
+    filename: str,
+    output_folder: str,
+    chunk_size: int = CHUNK_SIZE,
+    use_cache: bool = True,
+    storage: "StorageMode" = None,
+) -> str:
+    """Copy the file into output folder, renamed with its md5 hash as generate_md5_file.
+
+    The new name is the content hash, so when a file with that name already exists in output folder the copy is
+    skipped. With StorageMode.copy the file is hashed while it is copied, so it is read only once. The other storage
+    modes hash the file first, then hardlink or reflink it instead of copying bytes, falling back to a copy when the
+    filesystem does not support it. The hash is saved to the shared hash cache.
+
+    Args:
+        filename(str, path): path to the file
+        output_folder(str, path): folder to copy the file into
+        chunk_size(int): number of bytes read at a time
+        use_cache(bool): whether to use the shared hash cache
+        storage(StorageMode): how to store the new file, default to copy
+
+    Returns:
+        str: new file name, md5 hash with the original suffix
+    """
+    filename = Path(filename)
+    output_folder = Path(output_folder)
+    storage = storage or StorageMode.copy
+    cache = get_hash_cache() if use_cache else None
+    stat = os.stat(filename)
+
+    md5 = cache.get(filename, stat) if cache is not None else None
+
+    if md5 is None and storage is not StorageMode.copy:
+        md5 = generate_md5_file(filename, chunk_size, use_cache)
+
+    # Same content already stored, nothing to write
+    if md5 is not None:
+        new_file = output_folder / (md5 + filename.suffix)
+
+        if new_file.exists():
+            return new_file.name
+
+    tmp_file = None
+
+    try:
+        with tempfile.NamedTemporaryFile(dir=output_folder, suffix=PART_SUFFIX, delete=False) as fdst:
+            tmp_file = fdst.name
+
+            if md5 is None:
+                md5hash = hashlib.md5()
+
+                with open(filename, "rb") as fsrc:
+                    while chunk := fsrc.read(chunk_size):
+                        md5hash.update(chunk)
+                        fdst.write(chunk)
+
+                md5 = md5hash.hexdigest()
+            else:
+                fdst.close()
+                os.remove(tmp_file)
+                _link_file(filename, tmp_file, storage)
+
+        new_file = output_folder / (md5 + filename.suffix)
+
+        if not new_file.exists():
+            if storage is StorageMode.copy:
+                shutil.copymode(filename, tmp_file)
+            os.replace(tmp_file, new_file)
+    finally:
+        # Left on an error or an interruption, or when the same content is already stored
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    if cache is not None:
+        cache.put(filename, md5, stat)
+        cache.put(new_file, md5)
+
+    return new_file.name
+
+
+def bounded_map(executor, fn, iterable, max_pending: int):
+    """Like executor.map, but keep at most max_pending tasks in flight and yield results in order.
+
+    Args:
+        executor (concurrent.futures.Executor): executor to submit the tasks to
+        fn (callable): function applied to every item
+        iterable (iterable): input items, consumed lazily
+        max_pending (int): maximum number of submitted but not yet yielded tasks
+
+    Yields:
+        result of fn for every item, in input order
+    """
+    pending = []
+
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+
+        if len(pending) >= max_pending:
+            yield pending.pop(0).result()
+
+    for future in pending:
+        yield future.result()
+
+
+CONFIG_CACHE_FOLDER = Path.home() / ".cache" / "dataset-template" / "config"
+
+# Config lists of names, and the minimum number of names each must have. Headers are read by position: the
+# yolo_to_csv header starts with the old image path and name columns, the processed header with the old image name
+CONFIG_LISTS = {
+    "yolo_to_csv_header": 2,
+    "processed_data_header": 1,
+    "vehicle_makes": 1,
+    "vehicle_types": 1,
+    "vehicle_colors": 1,
+    "environment": 1,
+}
+
+
+def validate_config(config, file: str = "config") -> dict:
+    """Check a loaded config, see CONFIG_LISTS, and return it.
+
+    Raises:
+        ValueError: if the config is not a mapping, or a list of names is too short or has duplicates
+    """
+    if config is None:
+        return {}
+    if not isinstance(config, dict):
+        raise ValueError(f"{file} must be a mapping of config keys, got {type(config).__name__}")
+
+    for key, min_length in CONFIG_LISTS.items():
+        if key not in config:
+            continue
+
+        values = config[key]
+        if not isinstance(values, list) or not all(isinstance(v, str) and v for v in values):
+            raise ValueError(f"{file}: {key} must be a list of names, got {values!r}")
+        if len(values) < min_length:
+            raise ValueError(f"{file}: {key} must have at least {min_length} name(s), got {values!r}")
+
+        duplicates = sorted({v for v in values if values.count(v) > 1})
+        if duplicates:
+            raise ValueError(f"{file}: {key} has duplicate names {duplicates}")
+
+    return config
+
+
+def _config_cache_file(file: str) -> Path:
+    return CONFIG_CACHE_FOLDER / (hashlib.md5(os.path.abspath(file).encode()).hexdigest() + ".pkl")
+
+
+def load_yaml_file(file: str, use_cache: bool = True) -> dict:
+    """Load and validate yaml file for config, see validate_config.
+
+    The validated config is cached as a pickle, keyed by the size and modification time of the file, so the yaml is
+    only parsed again when the file changes.
 
     Args:
         file (str): file path to yaml file
+        use_cache (bool, optional): load the config from and save it to the cache. Defaults to True.
 
     Returns:
         dict: dict of loaded config
     """
-    with open(file, "r") as file:
-        return yaml.safe_load(file)
+    stat = os.stat(file)
+    key = [os.path.abspath(file), stat.st_size, stat.st_mtime_ns]
+    cache_file = _config_cache_file(file)
+
+    if use_cache:
+        try:
+            with open(cache_file, "rb") as f:
+                cached_key, config = pickle.load(f)
+            if cached_key == key:
+                return config
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):  # No, torn or incompatible cache, read the yaml
+            pass
+
+    with open(file, "r") as f:
+        config = validate_config(yaml.safe_load(f), file)
+
+    if use_cache:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+            with open(tmp_file, "wb") as f:
+                pickle.dump((key, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError:  # Read-only home, the config is parsed every time
+            pass
+
+    return config
 
 
 def cxywh2xyxy(x, one_dim=False):
@@ -97,3 +406,57 @@ def xywh2xyxy(x, one_dim=False):
     y[2] = x[0] + x[2]  # bottom right x
     y[3] = x[1] + x[3]  # bottom right y
     return y if one_dim else y.reshape(2, 2)
+
+
+def _as_boxes(x, img_size=None) -> np.ndarray:
+    """Convert input into a float (N, 4) array of boxes, scaled by image size if given."""
+    x = np.asarray(x, dtype=float)
+    if x.ndim == 1:
+        x = x.reshape(-1, 4)
+
+    assert x.ndim == 2 and x.shape[-1] == 4, f"input shape expected (N, 4) but input shape is {x.shape}"
+
+    if img_size is not None:
+        img_size = np.asarray(img_size, dtype=float)
+        x = x * np.tile(img_size, 2)  # (w, h) -> (w, h, w, h), broadcast over (N, 2) as well
+
+    return x
+
+
+def cxywh2xyxy_batch(x, img_size=None):
+    """
+    Convert N bounding boxes from (x, y, width, height) format to (x1, y1, x2, y2) format in one call, where (x, y)
+    is the box center, (x1, y1) is the top-left corner and (x2, y2) is the bottom-right corner.
+
+    Args:
+        x (np.ndarray): The input bounding box coordinates in (N, 4) (x, y, width, height) format.
+        img_size (tuple, np.ndarray): Optional (width, height), or (N, 2) array of it, to scale normalized coordinates.
+
+    Returns:
+        y (np.ndarray): The bounding box coordinates in (N, 4) (x1, y1, x2, y2) format.
+    """
+    x = _as_boxes(x, img_size)
+    y = np.empty_like(x)
+    half = x[:, 2:] / 2  # half-width, half-height
+    y[:, :2] = x[:, :2] - half  # top left xy
+    y[:, 2:] = x[:, :2] + half  # bottom right xy
+    return y
+
+
+def xywh2xyxy_batch(x, img_size=None):
+    """
+    Convert N bounding boxes from (x1, y1, width, height) format to (x1, y1, x2, y2) format in one call, where
+    (x1, y1) is the top-left corner and (x2, y2) is the bottom-right corner.
+
+    Args:
+        x (np.ndarray): The input bounding box coordinates in (N, 4) (x1, y1, width, height) format.
+        img_size (tuple, np.ndarray): Optional (width, height), or (N, 2) array of it, to scale normalized coordinates.
+
+    Returns:
+        y (np.ndarray): The bounding box coordinates in (N, 4) (x1, y1, x2, y2) format.
+    """
+    x = _as_boxes(x, img_size)
+    y = np.empty_like(x)
+    y[:, :2] = x[:, :2]  # top left xy
+    y[:, 2:] = x[:, :2] + x[:, 2:]  # bottom right xy
+    return y
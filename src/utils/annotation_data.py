@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+from src.utils.lazy import lazy_import
+
+hashlib = lazy_import("hashlib")
+pickle = lazy_import("pickle")
+pd = lazy_import("pandas")
+
+# Columns with few distinct values, stored as categoricals, and the config list of their allowed values
+CATEGORY_COLUMNS = {
+    "old_image_path": None,
+    "make": "vehicle_makes",
+    "type": "vehicle_types",
+    "colour": "vehicle_colors",
+    "environment": "environment",
+}
+SIDECAR_FOLDER = Path.home() / ".cache" / "dataset-template" / "annotator"
+
+
+def _sidecar_file(csv_file: str) -> Path:
+    # Kept in the user cache, not next to a possibly shared csv, so only pickles written by this user are loaded
+    return SIDECAR_FOLDER / (hashlib.md5(os.path.abspath(csv_file).encode()).hexdigest() + ".pkl")
+
+
+def _csv_key(csv_file: str) -> list:
+    stat = os.stat(csv_file)
+    return [os.path.abspath(csv_file), stat.st_size, stat.st_mtime_ns]
+
+
+def _read_csv(csv_file: str, dtype: dict) -> pd.DataFrame:
+    # The multithreaded pyarrow parser is several times faster on large files, every column is kept since the
+    # annotator writes the whole csv back
+    try:
+        return pd.read_csv(csv_file, dtype=dtype, engine="pyarrow")
+    except ImportError:
+        return pd.read_csv(csv_file, dtype=dtype, memory_map=True)
+
+
+def read_annotation_csv(csv_file: str, config: dict = None) -> pd.DataFrame:
+    """Read an interim csv for annotation, from its binary sidecar if it is up to date.
+
+    Columns with few distinct values are read as categoricals, which take a fraction of the memory of python strings.
+    Their categories are extended with the allowed values in config, so any valid annotation can be set in place.
+
+    Args:
+        csv_file (str): interim csv file
+        config (dict, optional): loaded config, for the allowed values of the categorical columns
+
+    Returns:
+        pd.DataFrame: csv data with a processed column
+    """
+    config = config or {}
+    sidecar_file = _sidecar_file(csv_file)
+
+    if sidecar_file.exists():
+        try:
+            with open(sidecar_file, "rb") as f:
+                key, data = pickle.load(f)
+            if key == _csv_key(csv_file):
+                return _add_categories(data, config)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):  # Torn or incompatible sidecar, read the csv
+            pass
+
+    columns = pd.read_csv(csv_file, nrows=0).columns
+    dtype = {column: "category" for column in CATEGORY_COLUMNS if column in columns}
+    data = _read_csv(csv_file, dtype)
+
+    if "processed" not in data.columns:
+        data["processed"] = False
+
+    data = _add_categories(data, config)
+    write_sidecar(csv_file, data)
+    return data
+
+
+def _add_categories(data: pd.DataFrame, config: dict) -> pd.DataFrame:
+    for column, config_key in CATEGORY_COLUMNS.items():
+        if column in data.columns and not isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].astype("category")
+
+        if column in data.columns and config_key in config:
+            categories = data[column].cat.categories
+            data[column] = data[column].cat.add_categories([v for v in config[config_key] if v not in categories])
+    return data
+
+
+def write_sidecar(csv_file: str, data: pd.DataFrame):
+    """Save data of a csv in the user cache, to be loaded instead of parsing the csv until the csv changes.
+
+    The annotator works without the sidecar if it cannot be written.
+
+    Args:
+        csv_file (str): csv file the data matches
+        data (pd.DataFrame): csv data
+    """
+    sidecar_file = _sidecar_file(csv_file)
+    tmp_file = sidecar_file.with_name(f"{sidecar_file.name}.{os.getpid()}.tmp")
+
+    try:
+        sidecar_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_file, "wb") as f:
+            pickle.dump((_csv_key(csv_file), data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, sidecar_file)
+    except OSError:  # Read-only or full cache folder, the csv is parsed again on the next start
+        pass
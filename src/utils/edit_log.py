@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+
+from src.utils.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+
+class EditLog:
+    """Append-only journal of row edits of a csv file, compacted back into the csv from time to time.
+
+    Every edit is one json line appended to <csv_file>.journal and flushed to disk, so saving an edit costs the same
+    whatever the size of the csv, and a crash loses at most the edit being written. Rows are identified by their
+    DataFrame index label, which is the row position in the csv when it was loaded.
+
+    The first line of the journal records the size and mtime of the csv it applies to. A journal left over after the
+    csv was compacted does not match anymore and is ignored.
+
+    Args:
+        csv_file (str): csv file the edits apply to
+        compact_every (int, optional): number of edits after which compact should be called. Defaults to 1000.
+    """
+
+    def __init__(self, csv_file: str, compact_every: int = 1000):
+        self.csv_file = Path(csv_file)
+        self.journal_file = self.csv_file.with_name(self.csv_file.name + ".journal")
+        self.compact_every = compact_every
+        self.pending = 0
+        self._journal = None
+
+    def _base(self) -> list:
+        stat = os.stat(self.csv_file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def replay(self, data: pd.DataFrame) -> bool:
+        """Apply the edits of the journal to data loaded from the csv, in place.
+
+        Args:
+            data (pd.DataFrame): csv data, with its default index
+
+        Returns:
+            bool: whether any edit was applied
+        """
+        if not self.journal_file.exists():
+            return False
+
+        with open(self.journal_file, "r") as f:
+            lines = f.read().splitlines()
+
+        if not lines or json.loads(lines[0]).get("base") != self._base():
+            return False
+
+        deleted = []
+
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:  # Incomplete last line of a crash
+                break
+
+            if entry["op"] == "update":
+                for column, value in entry["values"].items():
+                    data.at[entry["row"], column] = value
+            elif entry["op"] == "delete":
+                deleted.append(entry["row"])
+
+        data.drop(deleted, inplace=True)
+        self.pending = len(lines) - 1
+        return True
+
+    def _append(self, entry: dict):
+        if self._journal is None:
+            is_new = not self.journal_file.exists() or self.pending == 0
+            self._journal = open(self.journal_file, "w" if is_new else "a")
+
+            if is_new:
+                self._journal.write(json.dumps({"base": self._base()}) + "\n")
+
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.pending += 1
+
+    def update(self, row, values: dict):
+        """Record new values of a row.
+
+        Args:
+            row (int): index label of the row
+            values (dict): mapping of column to new value
+        """
+        self._append({"op": "update", "row": int(row), "values": values})
+
+    def delete(self, row):
+        """Record deletion of a row.
+
+        Args:
+            row (int): index label of the row
+        """
+        self._append({"op": "delete", "row": int(row)})
+
+    @property
+    def should_compact(self) -> bool:
+        return self.pending >= self.compact_every
+
+    def compact(self, data: pd.DataFrame):
+        """Write data to the csv atomically and start an empty journal.
+
+        The index of data is reset in place, so its labels match the row positions of the new csv.
+
+        Args:
+            data (pd.DataFrame): current data, with all journal edits applied
+        """
+        self.close()
+
+        tmp_file = self.csv_file.with_name(self.csv_file.name + ".tmp")
+        with open(tmp_file, "w", newline="") as f:
+            data.to_csv(f, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_file, self.csv_file)
+
+        if self.journal_file.exists():
+            os.remove(self.journal_file)
+
+        data.reset_index(drop=True, inplace=True)
+        self.pending = 0
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
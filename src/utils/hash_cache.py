@@ -0,0 +1,157 @@
+import argparse
+import os
+import threading
+from pathlib import Path
+
+import colorama
+from colorama import Fore
+
+from src.utils.lazy import lazy_import
+
+sqlite3 = lazy_import("sqlite3")
+
+colorama.init()
+
+DEFAULT_CACHE_FILE = Path.home() / ".cache" / "dataset-template" / "md5.sqlite"
+
+
+class HashCache:
+    """On-disk cache of file md5 hashes keyed by (path, size, mtime_ns, inode).
+
+    An entry is only a hit when the file still has the same size, modification time and inode as when it was hashed,
+    so a modified or replaced file is always hashed again. The cache is a SQLite database, safe to share between
+    threads and between processes running at the same time.
+    """
+
+    def __init__(self, cache_file: str = DEFAULT_CACHE_FILE):
+        self.cache_file = Path(cache_file)
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.cache_file, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS md5 ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, md5 TEXT)"
+        )
+        self._conn.commit()
+
+    def get(self, filename: str, stat: os.stat_result = None) -> str | None:
+        """Return the cached md5 of the file, or None if it is not cached or the file changed.
+
+        Args:
+            filename (str, path): path to the file
+            stat (os.stat_result, optional): stat of the file, to avoid a second stat call
+
+        Returns:
+            str | None: md5 hex digest
+        """
+        stat = stat or os.stat(filename)
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT md5 FROM md5 WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, stat.st_ino),
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def put(self, filename: str, md5: str, stat: os.stat_result = None):
+        """Store the md5 of the file.
+
+        Args:
+            filename (str, path): path to the file
+            md5 (str): md5 hex digest of the file
+            stat (os.stat_result, optional): stat of the file taken before it was hashed
+        """
+        stat = stat or os.stat(filename)
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO md5 VALUES (?, ?, ?, ?, ?)",
+                (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, stat.st_ino, md5),
+            )
+            self._conn.commit()
+
+    def prune(self) -> int:
+        """Evict entries whose file no longer exists or was modified since it was hashed.
+
+        Returns:
+            int: number of evicted entries
+        """
+        stale = []
+
+        with self._lock:
+            for path, size, mtime_ns, inode in self._conn.execute("SELECT path, size, mtime_ns, inode FROM md5"):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    stale.append((path,))
+                    continue
+
+                if (stat.st_size, stat.st_mtime_ns, stat.st_ino) != (size, mtime_ns, inode):
+                    stale.append((path,))
+
+            self._conn.executemany("DELETE FROM md5 WHERE path = ?", stale)
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+
+        return len(stale)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM md5").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_cache = None
+_cache_pid = None
+
+
+def get_hash_cache() -> HashCache | None:
+    """Return the hash cache shared by every caller of generate_md5_file in this process.
+
+    The cache file is taken from the MD5_CACHE_FILE environment variable, default to
+    ~/.cache/dataset-template/md5.sqlite. Set MD5_CACHE_FILE to an empty string to disable the cache.
+
+    Returns:
+        HashCache | None: shared cache, None if disabled
+    """
+    global _cache, _cache_pid
+
+    cache_file = os.environ.get("MD5_CACHE_FILE", str(DEFAULT_CACHE_FILE))
+
+    if not cache_file:
+        return None
+
+    # SQLite connection must not be shared with forked worker process
+    if _cache is None or _cache_pid != os.getpid() or _cache.cache_file != Path(cache_file):
+        _cache = HashCache(cache_file)
+        _cache_pid = os.getpid()
+
+    return _cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the md5 hash cache used by generate_md5_file.")
+
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        help="Cache file path. (default: %(default)s)",
+        default=os.environ.get("MD5_CACHE_FILE") or str(DEFAULT_CACHE_FILE),
+    )
+    parser.add_argument("--prune", action="store_true", help="Evict entries of missing or modified files")
+
+    args = parser.parse_args()
+
+    cache = HashCache(args.cache_file)
+
+    if args.prune:
+        print(Fore.GREEN + f"Evicted {cache.prune()} entries from {args.cache_file}")
+    else:
+        print(f"{len(cache)} entries in {args.cache_file}")
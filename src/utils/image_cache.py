@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple
+
+from src.utils.lazy import lazy_import
+
+futures = lazy_import("concurrent.futures")
+hashlib = lazy_import("hashlib")
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+
+
+class PreparedImage(NamedTuple):
+    image: Image.Image  # thumbnail of the image, with plate box drawn
+    lp_image: Image.Image | None  # zoomed plate crop, None if no box
+    lp_image_lanczos: Image.Image | None  # zoomed plate crop with LANCZOS resampling, None if no box
+
+    @property
+    def nbytes(self) -> int:
+        return sum(img.width * img.height * len(img.getbands()) for img in self if img is not None)
+
+
+def decode_image(image_file: str, box: tuple = None, size: tuple = (500, 440)) -> tuple:
+    """Decode the thumbnail with plate box drawn, and the plate crop at full resolution.
+
+    With a box, the image is decoded once at full resolution, since JPEG cannot be decoded by region, and both the
+    plate crop and the thumbnail come from it. Without a box, JPEG images are decoded at reduced scale with Image.draft.
+
+    Args:
+        image_file (str, path): path to the image
+        box (tuple, optional): plate box (x1, y1, x2, y2) in full resolution image coordinates
+        size (tuple, optional): maximum size of the thumbnail. Defaults to (500, 440).
+
+    Returns:
+        tuple: thumbnail, and plate crop or None if no box
+    """
+    img = Image.open(image_file)
+    full_width, full_height = img.size
+    lp_img = None
+
+    if box is None:
+        img.draft(None, size)  # No-op for formats other than JPEG
+        img.thumbnail(size)
+        return img, lp_img
+
+    img.load()
+    lp_img = img.crop(box)
+    img.thumbnail(size)
+
+    scale_x, scale_y = img.width / full_width, img.height / full_height
+    x1, y1, x2, y2 = box
+
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y], outline="aquamarine", width=2)
+
+    return img, lp_img
+
+
+def _cache_files(cache_dir: str, image_file: str, box: tuple, size: tuple) -> tuple[Path, Path]:
+    """Thumbnail and plate crop file in cache_dir, keyed by the image file, its size and mtime, box and size."""
+    stat = os.stat(image_file)
+    key = repr((os.path.abspath(image_file), stat.st_size, stat.st_mtime_ns, box, size))
+    name = hashlib.md5(key.encode()).hexdigest()
+    return Path(cache_dir) / f"{name}.jpg", Path(cache_dir) / f"{name}_lp.png"
+
+
+def _save_atomic(img: Image.Image, file: Path, **kwargs):
+    tmp_file = file.with_name(f"{file.stem}.{threading.get_ident()}.tmp{file.suffix}")
+    img.save(tmp_file, **kwargs)
+    os.replace(tmp_file, file)
+
+
+def prepare_image(
+    image_file: str,
+    box: tuple = None,
+    size: tuple = (500, 440),
+    zoom: int = 3,
+    cache_dir: str = None,
+) -> PreparedImage:
+    """Decode the image and render everything the annotator displays for it.
+
+    Args:
+        image_file (str, path): path to the image
+        box (tuple, optional): plate box (x1, y1, x2, y2) in image coordinates
+        size (tuple, optional): maximum size of the thumbnail. Defaults to (500, 440).
+        zoom (int, optional): zoom factor of the plate crop. Defaults to 3.
+        cache_dir (str, optional): folder to keep decoded thumbnails and plate crops across sessions.
+
+    Returns:
+        PreparedImage: thumbnail and zoomed plate crops
+    """
+    if box is not None:
+        box = tuple(int(v) for v in box)
+
+    thumbnail_file = lp_file = None
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        thumbnail_file, lp_file = _cache_files(cache_dir, image_file, box, size)
+
+    if thumbnail_file is not None and thumbnail_file.exists() and (box is None or lp_file.exists()):
+        img = Image.open(thumbnail_file)
+        lp_img = Image.open(lp_file) if box is not None else None
+    else:
+        img, lp_img = decode_image(image_file, box, size)
+
+        if thumbnail_file is not None:
+            if lp_img is not None:
+                _save_atomic(lp_img, lp_file)
+            _save_atomic(img.convert("RGB"), thumbnail_file, quality=90)
+
+    img.load()
+    lp_img_lanczos = None
+
+    # Zoom license plate image
+    if lp_img is not None:
+        width, height = (lp_img.width * zoom, lp_img.height * zoom)
+        lp_img_lanczos = lp_img.resize((width, height), Image.LANCZOS)
+        lp_img = lp_img.resize((width, height))
+
+    return PreparedImage(img, lp_img, lp_img_lanczos)
+
+
+class ImagePrefetcher:
+    """Prepare images in background threads and keep them in a memory bounded LRU cache.
+
+    Images are identified by (image_file, box). prefetch schedules images that are likely to be displayed next, get
+    returns a prepared image from the cache, waits for it if it is being prepared, or prepares it right away.
+
+    Args:
+        max_bytes (int, optional): memory budget of the cached images. Defaults to 256 MiB.
+        workers (int, optional): number of background threads. Defaults to 2.
+        **kwargs: passed to prepare_image
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, workers: int = 2, **kwargs):
+        self.max_bytes = max_bytes
+        self.kwargs = kwargs
+
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+
+    def _prepare(self, key: tuple) -> PreparedImage:
+        try:
+            prepared = prepare_image(*key, **self.kwargs)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = prepared
+                self._nbytes += prepared.nbytes
+
+            # Evict least recently used images
+            while self._nbytes > self.max_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+        return prepared
+
+    def get(self, image_file: str, box: tuple = None) -> PreparedImage:
+        """Return the prepared image, preparing it in the calling thread if it is not cached or scheduled."""
+        key = (str(image_file), box)
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            future = self._pending.get(key)
+
+        if future is not None and not future.cancelled():
+            return future.result()
+
+        return self._prepare(key)
+
+    def prefetch(self, items: list):
+        """Schedule images to be prepared in background, cancelling scheduled images that are no longer wanted.
+
+        Args:
+            items (list): list of (image_file, box), most wanted first
+        """
+        keys = [(str(image_file), box) for image_file, box in items]
+
+        with self._lock:
+            for key in set(self._pending) - set(keys):
+                if self._pending[key].cancel():
+                    del self._pending[key]
+
+            for key in keys:
+                if key not in self._cache and key not in self._pending:
+                    self._pending[key] = self._executor.submit(self._prepare, key)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
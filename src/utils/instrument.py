@@ -0,0 +1,281 @@
+import io
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from src.utils.lazy import lazy_import
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+cProfile = lazy_import("cProfile")
+datetime = lazy_import("datetime")
+json = lazy_import("json")
+platform = lazy_import("platform")
+pstats = lazy_import("pstats")
+
+PROGRESS_INTERVAL = 0.5  # seconds between progress lines
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of this process and its finished children in MiB, None if unknown."""
+    if resource is None:
+        return None
+
+    # ru_maxrss is in KiB on Linux, in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak * unit / 2**20
+
+
+class Progress:
+    """Progress line with count, rate and ETA, redrawn on stderr at most every PROGRESS_INTERVAL seconds.
+
+    It is only shown when enabled, by default when stderr is a terminal, so logs of batch jobs stay clean. When not
+    shown, update only adds to the count.
+
+    Args:
+        total (int, optional): expected count, for the percentage and ETA. Defaults to unknown.
+        desc (str, optional): text in front of the count. Defaults to "".
+        unit (str, optional): name of what is counted, e.g. files. Defaults to "it".
+        enabled (bool, optional): whether to show the progress. Defaults to the run setting, see run.
+    """
+
+    def __init__(self, total: int = None, desc: str = "", unit: str = "it", enabled: bool = None):
+        self.total = total
+        self.desc = desc
+        self.unit = unit
+        self.enabled = RUN.progress if enabled is None else enabled
+        self.count = 0
+        self.start = time.monotonic()
+        self._next_draw = self.start + PROGRESS_INTERVAL
+        self._width = 0
+
+    def update(self, n: int = 1):
+        self.count += n
+
+        if self.enabled and (now := time.monotonic()) >= self._next_draw:
+            self._next_draw = now + PROGRESS_INTERVAL
+            self._draw(now)
+
+    def _draw(self, now: float):
+        elapsed = now - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        line = f"{self.desc}: {self.count}" if self.desc else f"{self.count}"
+
+        if self.total:
+            line += f"/{self.total} {self.unit} {self.count / self.total:.0%}"
+            eta = (self.total - self.count) / rate if rate > 0 else None
+            line += f", {rate:.1f} {self.unit}/s, ETA {_format_duration(eta) if eta is not None else '?'}"
+        else:
+            line += f" {self.unit}, {rate:.1f} {self.unit}/s, {_format_duration(elapsed)}"
+
+        sys.stderr.write("\r" + line.ljust(self._width))
+        sys.stderr.flush()
+        self._width = len(line)
+
+    def write(self, text: str):
+        """Print a line to stdout, above the progress line."""
+        if self._width:
+            sys.stderr.write("\r" + " " * self._width + "\r")
+            sys.stderr.flush()
+            self._width = 0
+            self._next_draw = 0.0
+
+        print(text)
+
+    def close(self):
+        if self.enabled and self._width:
+            self._draw(time.monotonic())
+            sys.stderr.write("\n")
+            sys.stderr.flush()
+            self._width = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def progress(iterable, total: int = None, desc: str = "", unit: str = "it"):
+    """Yield the items of iterable, with a Progress of one per item. total defaults to len(iterable) if it has one."""
+    if total is None and hasattr(iterable, "__len__"):
+        total = len(iterable)
+
+    with Progress(total, desc, unit) as bar:
+        for item in iterable:
+            yield item
+            bar.update()
+
+
+class Run:
+    """Timings and counters of one script run, reported as json.
+
+    Stages are timed blocks of the run, counters such as files, bytes and rows are added to the current stages and to
+    the run total.
+
+    Args:
+        name (str): script name
+        progress (bool, optional): whether Progress is shown by default. Defaults to whether stderr is a terminal.
+    """
+
+    def __init__(self, name: str = None, progress: bool = None):
+        self.name = name or os.path.basename(sys.argv[0])
+        self.progress = sys.stderr.isatty() if progress is None else progress
+        self.start = time.time()
+        self.counters = {}
+        self.stages = []
+        self._active = []
+
+    def count(self, **counters):
+        """Add to counters, e.g. count(files=1, bytes=size)."""
+        for target in [self.counters] + [stage["counters"] for stage in self._active]:
+            for name, value in counters.items():
+                target[name] = target.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a block of the run, with the counters added in it. Stages in a stage have a larger depth."""
+        stage = {"name": name, "depth": len(self._active), "seconds": 0.0, "counters": {}}
+        self.stages.append(stage)
+        self._active.append(stage)
+        start = time.perf_counter()
+
+        try:
+            yield stage
+        finally:
+            stage["seconds"] = time.perf_counter() - start
+            self._active.remove(stage)
+
+    def report(self) -> dict:
+        """Run report, with the per second rate of every counter of the run and of every stage."""
+        seconds = time.time() - self.start
+
+        def rates(counters: dict, seconds: float) -> dict:
+            return {f"{name}_per_s": value / seconds for name, value in counters.items() if seconds > 0}
+
+        return {
+            "script": self.name,
+            "argv": sys.argv[1:],
+            "start": datetime.datetime.fromtimestamp(self.start, datetime.timezone.utc).isoformat(),
+            "seconds": seconds,
+            "counters": self.counters,
+            "rates": rates(self.counters, seconds),
+            "stages": [{**stage, "rates": rates(stage["counters"], stage["seconds"])} for stage in self.stages],
+            "peak_rss_mb": peak_rss_mb(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        }
+
+    def summary(self) -> str:
+        """Stage timings and counters as text."""
+        lines = []
+
+        total = {"name": "total", "depth": 0, "seconds": time.time() - self.start, "counters": self.counters}
+
+        for stage in self.stages + [total]:
+            rates = ", ".join(
+                f"{value} {name} ({value / stage['seconds']:.1f}/s)" if stage["seconds"] > 0 else f"{value} {name}"
+                for name, value in stage["counters"].items()
+            )
+            name = "  " * stage["depth"] + stage["name"]
+            lines.append(f"{name:<34} {stage['seconds']:>9.3f} s  {rates}".rstrip())
+
+        return "\n".join(lines)
+
+
+# Run of the current script, counters and stages outside of a run command are kept but not reported
+RUN = Run()
+
+
+def count(**counters):
+    """Add to the counters of the current run, see Run.count."""
+    RUN.count(**counters)
+
+
+def stage(name: str):
+    """Time a block of the current run, see Run.stage."""
+    return RUN.stage(name)
+
+
+def add_arguments(parser):
+    """Add the --progress, --no_progress, --profile and --report options to an argument parser."""
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument(
+        "--progress",
+        action="store_true",
+        default=None,
+        help="Show progress with ETA, default when stderr is a terminal",
+    )
+    group.add_argument("--no_progress", action="store_false", dest="progress", help="Do not show progress")
+    group.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        metavar="PROFILE_FILE",
+        help="Print stage timings and the slowest functions, and save the cProfile stats to PROFILE_FILE if given",
+    )
+    group.add_argument("--report", type=str, metavar="REPORT_FILE", help="Save a json run report")
+
+
+@contextmanager
+def run(args, name: str = None):
+    """Instrument the run of a script with the options of add_arguments.
+
+    The report is saved even if the run fails, with the error. cProfile only profiles this process, not the workers of
+    process pools.
+
+    Args:
+        args (argparse.Namespace): parsed arguments with the options of add_arguments
+        name (str, optional): script name in the report. Defaults to the name of the script file.
+
+    Yields:
+        Run: the current run
+    """
+    global RUN
+    RUN = Run(name, getattr(args, "progress", None))
+    profile_file = getattr(args, "profile", None)
+    report_file = getattr(args, "report", None)
+    profiler = cProfile.Profile() if profile_file is not None else None
+    error = None
+
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield RUN
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            stats = io.StringIO()
+            pstats.Stats(profiler, stream=stats).sort_stats("cumulative").print_stats(20)
+            print(RUN.summary() + "\n" + stats.getvalue(), file=sys.stderr)
+
+            if profile_file:
+                profiler.dump_stats(profile_file)
+                print(
+                    f"Profile saved as {profile_file}, view it with `python -m pstats {profile_file}`", file=sys.stderr
+                )
+
+        if report_file:
+            report = RUN.report()
+            report["error"] = error
+            with open(report_file, "w") as f:
+                json.dump(report, f, indent=2)
+                f.write("\n")
@@ -0,0 +1,24 @@
+import importlib
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+    """Placeholder of a module, replaced by its content on first attribute access."""
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(vars(module))
+        return getattr(module, attr)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Module imported on first use, so a script only pays for the imports it needs, e.g. not pandas for --help.
+
+    Args:
+        name (str): module name, e.g. "pandas" or "PIL.Image"
+
+    Returns:
+        types.ModuleType: the module if already imported, else a placeholder importing it on first attribute access
+    """
+    return sys.modules.get(name) or _LazyModule(name)
@@ -0,0 +1,53 @@
+from bisect import bisect_left, bisect_right
+
+from src.utils.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+
+class PositionSet:
+    """Sorted set of row positions with O(log N) lookup of the next and previous position.
+
+    Args:
+        positions (iterable, optional): initial positions
+    """
+
+    def __init__(self, positions=()):
+        positions = np.sort(
+            np.asarray(positions if isinstance(positions, np.ndarray) else list(positions), dtype=np.int64)
+        )
+        self._positions = positions[np.r_[True, positions[1:] != positions[:-1]]].tolist() if len(positions) else []
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, position: int) -> bool:
+        i = bisect_left(self._positions, position)
+        return i < len(self._positions) and self._positions[i] == position
+
+    def add(self, position: int):
+        i = bisect_left(self._positions, position)
+        if i == len(self._positions) or self._positions[i] != position:
+            self._positions.insert(i, int(position))
+
+    def discard(self, position: int):
+        i = bisect_left(self._positions, position)
+        if i < len(self._positions) and self._positions[i] == position:
+            del self._positions[i]
+
+    def first(self) -> int | None:
+        return self._positions[0] if self._positions else None
+
+    def next(self, position: int) -> int | None:
+        """Smallest position greater than the given position, None if there is none."""
+        i = bisect_right(self._positions, position)
+        return self._positions[i] if i < len(self._positions) else None
+
+    def previous(self, position: int) -> int | None:
+        """Largest position smaller than the given position, None if there is none."""
+        i = bisect_left(self._positions, position)
+        return self._positions[i - 1] if i > 0 else None
+
+    def rank(self, position: int) -> int:
+        """Number of positions smaller than the given position."""
+        return bisect_left(self._positions, position)
@@ -0,0 +1,198 @@
+import csv
+import glob
+import io
+import os
+from pathlib import Path
+
+from src.utils.lazy import lazy_import
+
+tarfile = lazy_import("tarfile")
+
+INDEX_HEADER = ["key", "ext", "shard", "offset", "size"]
+TAR_BLOCK = 512
+
+
+class ShardWriter:
+    """Write samples to consecutive tar shards, <prefix>-000000.tar, ...
+
+    Every sample is a group of files sharing a key, <key>.png and <key>.txt, as read by WebDataset. A new shard is
+    started after shard_size samples or once a shard reaches shard_bytes. Members have no time stamp, so the same
+    samples always make the same shards.
+
+    With index_file, the shard, offset and size of every member are saved as a tab separated file on close, for
+    ShardReader random access. Shards of a previous run with the same prefix are removed, so a smaller run into the same
+    folder does not leave old shards next to the new ones.
+
+    Args:
+        output_folder (str, path): folder of the shards
+        prefix (str, optional): shard file name prefix. Defaults to "crops".
+        shard_size (int, optional): number of samples per shard. Defaults to 10000.
+        shard_bytes (int, optional): size of a shard to start a new one. Defaults to no limit.
+        index_file (str, path, optional): index file name in output_folder. Defaults to no index.
+    """
+
+    def __init__(
+        self,
+        output_folder,
+        prefix: str = "crops",
+        shard_size: int = 10000,
+        shard_bytes: int = None,
+        index_file=None,
+    ):
+        self.output_folder = Path(output_folder)
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard_bytes = shard_bytes
+        self.index_file = self.output_folder / index_file if index_file is not None else None
+        self.shards = []
+        self.index = []
+        self.count = 0
+        self._tar = None
+        self._shard_count = 0
+
+        for shard in self.output_folder.glob(f"{glob.escape(prefix)}-[0-9][0-9][0-9][0-9][0-9][0-9].tar"):
+            shard.unlink()
+
+    def _is_full(self) -> bool:
+        if self.shard_size is not None and self._shard_count >= self.shard_size:
+            return True
+        return self.shard_bytes is not None and self._tar.offset >= self.shard_bytes
+
+    def write(self, key: str, files: dict):
+        """Add a sample, files maps extension to content bytes."""
+        if self._tar is None or self._is_full():
+            self._close_shard()
+            shard = self.output_folder / f"{self.prefix}-{len(self.shards):06d}.tar"
+            self._tar = tarfile.open(shard, "w")
+            self.shards.append(shard)
+            self._shard_count = 0
+
+        for ext, content in files.items():
+            info = tarfile.TarInfo(f"{key}.{ext}")
+            info.size = len(content)
+            self._tar.addfile(info, io.BytesIO(content))
+
+            # The content ends at the current offset, before its padding to a whole block
+            offset = self._tar.offset - -(-len(content) // TAR_BLOCK) * TAR_BLOCK
+            self.index.append((key, ext, self.shards[-1].name, offset, len(content)))
+
+        self.count += 1
+        self._shard_count += 1
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def close(self):
+        self._close_shard()
+
+        if self.index_file is not None:
+            tmp_file = self.index_file.with_name(self.index_file.name + ".tmp")
+            with open(tmp_file, "w", newline="") as f:
+                writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+                writer.writerow(INDEX_HEADER)
+                writer.writerows(self.index)
+            os.replace(tmp_file, self.index_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShardReader:
+    """Read samples of tar shards written by ShardWriter, by key from the index or streamed shard by shard.
+
+    Random access reads the bytes of a member at its indexed offset, without reading the tar headers. Streaming reads
+    every shard sequentially, and shard_files splits the shards between parallel readers.
+
+    Args:
+        index_file (str, path): index file saved by ShardWriter, next to the shards
+    """
+
+    def __init__(self, index_file):
+        self.index_file = Path(index_file)
+        self.folder = self.index_file.parent
+        self.samples = {}
+        self._files = {}
+
+        with open(self.index_file, "r", newline="") as f:
+            reader = csv.reader(f, delimiter="\t")
+            next(reader, None)
+            for key, ext, shard, offset, size in reader:
+                self.samples.setdefault(key, {})[ext] = (shard, int(offset), int(size))
+
+        self.shards = sorted({shard for files in self.samples.values() for shard, _, _ in files.values()})
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.samples
+
+    def keys(self) -> list:
+        return list(self.samples)
+
+    def __getitem__(self, key: str) -> dict:
+        """Files of a sample, mapping extension to content bytes."""
+        return {ext: self._read(shard, offset, size) for ext, (shard, offset, size) in self.samples[key].items()}
+
+    def _read(self, shard: str, offset: int, size: int) -> bytes:
+        if shard not in self._files:
+            self._files[shard] = open(self.folder / shard, "rb")
+
+        f = self._files[shard]
+        f.seek(offset)
+        return f.read(size)
+
+    def shard_files(self, rank: int = 0, world_size: int = 1) -> list:
+        """Shards of one of world_size parallel readers, every shard is read by one reader."""
+        return [self.folder / shard for shard in self.shards[rank::world_size]]
+
+    def stream(self, rank: int = 0, world_size: int = 1):
+        """Stream the samples of the shards of a reader, see shard_files.
+
+        Yields:
+            tuple: key and files of every sample, files maps extension to content bytes
+        """
+        for shard in self.shard_files(rank, world_size):
+            yield from iter_shard(shard)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_shard(shard_file):
+    """Stream the samples of a tar shard in one sequential read, grouping consecutive members by key.
+
+    Yields:
+        tuple: key and files of every sample, files maps extension to content bytes
+    """
+    key, files = None, {}
+
+    with tarfile.open(shard_file, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            # Keys may contain dots, extensions written by ShardWriter do not
+            member_key, _, ext = member.name.rpartition(".")
+            if member_key != key and files:
+                yield key, files
+                files = {}
+
+            key = member_key
+            files[ext] = tar.extractfile(member).read()
+
+    if files:
+        yield key, files
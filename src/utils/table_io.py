@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+from enum import Enum
+from pathlib import Path
+
+from src.utils.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+
+class TableFormat(Enum):
+    csv = 1  # text, no column types (Default)
+    parquet = 2  # columnar, compressed, read by column
+    feather = 3  # Arrow IPC file, fastest to load
+    default = csv
+
+    @classmethod
+    def all_option(cls):
+        return [fmt.name for fmt in list(TableFormat)]
+
+    @classmethod
+    def from_file(cls, file) -> "TableFormat":
+        """Format of a table file from its extension, e.g. .parquet."""
+        try:
+            return cls[Path(file).suffix.lstrip(".").lower()]
+        except KeyError:
+            raise ValueError(f"Unsupported table file {file}, must end with one of {TABLE_SUFFIXES}")
+
+    @property
+    def suffix(self) -> str:
+        return f".{self.name}"
+
+
+TABLE_SUFFIXES = [fmt.suffix for fmt in TableFormat]
+
+# Column of the processed data and the config list of its allowed values, stored as categoricals
+CATEGORY_CONFIG = {
+    "make": "vehicle_makes",
+    "type": "vehicle_types",
+    "colour": "vehicle_colors",
+    "environment": "environment",
+}
+
+# Column types in parquet and feather files, other columns are stored as strings
+INTEGER_COLUMNS = ["x1", "y1", "x2", "y2"]
+BOOLEAN_COLUMNS = ["isBack", "processed"]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("pyarrow is required for parquet and feather files, install it with `pip install pyarrow`")
+    return pyarrow
+
+
+def config_categories(config: dict) -> dict:
+    """Allowed values of every categorical column found in config, e.g. {"make": ["perodua", ...]}."""
+    return {column: config[key] for column, key in CATEGORY_CONFIG.items() if key in config}
+
+
+def table_columns(file) -> list:
+    """Column names of a table file, without reading its rows."""
+    fmt = TableFormat.from_file(file)
+
+    if fmt is TableFormat.csv:
+        return list(pd.read_csv(file, nrows=0).columns)
+
+    pa = _import_pyarrow()
+
+    if fmt is TableFormat.parquet:
+        import pyarrow.parquet as pq
+
+        return pq.read_schema(file).names
+
+    with pa.memory_map(str(file)) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def read_table(file, columns: list = None, **csv_kwargs) -> pd.DataFrame:
+    """Read a csv, parquet or feather file.
+
+    Parquet and feather files only read the given columns from disk, and keep the column types they were written with.
+
+    Args:
+        file (str, path): table file, its format is given by its extension
+        columns (list, optional): columns to read. Defaults to all.
+        **csv_kwargs: passed to pd.read_csv for csv files
+
+    Returns:
+        pd.DataFrame: table data
+    """
+    fmt = TableFormat.from_file(file)
+
+    if fmt is TableFormat.csv:
+        return pd.read_csv(file, usecols=columns, **csv_kwargs)
+
+    _import_pyarrow()
+
+    if fmt is TableFormat.parquet:
+        return pd.read_parquet(file, columns=columns)
+
+    return pd.read_feather(file, columns=columns)
+
+
+def read_table_chunks(file, chunk_size: int = 100_000, columns: list = None, **csv_kwargs):
+    """Read a table file in DataFrames of at most chunk_size rows.
+
+    Args:
+        file (str, path): table file, its format is given by its extension
+        chunk_size (int, optional): number of rows per chunk. Defaults to 100_000.
+        columns (list, optional): columns to read. Defaults to all.
+        **csv_kwargs: passed to pd.read_csv for csv files
+
+    Yields:
+        pd.DataFrame: consecutive rows of the table, with a default index from 0
+    """
+    fmt = TableFormat.from_file(file)
+
+    if fmt is TableFormat.csv:
+        with pd.read_csv(file, usecols=columns, chunksize=chunk_size, **csv_kwargs) as reader:
+            yield from (chunk.reset_index(drop=True) for chunk in reader)
+        return
+
+    pa = _import_pyarrow()
+
+    if fmt is TableFormat.parquet:
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+        return
+
+    with pa.memory_map(str(file)) as source:
+        reader = pa.ipc.open_file(source)
+
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            batch = batch.select(columns) if columns is not None else batch
+
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(offset, chunk_size).to_pandas()
+
+
+def _to_boolean(values: pd.Series) -> pd.Series:
+    text = values.astype("string").str.lower()
+    result = text.map({"true": True, "false": False, "1": True, "0": False}, na_action="ignore")
+
+    if (unknown := text[result.isna() & text.notna() & (text != "")]).size:
+        raise ValueError(f"Invalid {values.name} values, must be True or False: {sorted(unknown.unique())[:10]}")
+
+    return result.astype("boolean")
+
+
+def encode_table(data: pd.DataFrame, categories: dict = None) -> pd.DataFrame:
+    """Convert data to the column types of parquet and feather files.
+
+    Coordinates are nullable integers, isBack and processed nullable booleans, columns in categories categoricals with
+    the given categories, and every other column a nullable string. Empty strings are stored as missing values. The
+    types only depend on the column names, so every chunk of a file has the same schema.
+
+    Args:
+        data (pd.DataFrame): data as read from csv, with or without dtype=str
+        categories (dict, optional): allowed values of categorical columns, see config_categories
+
+    Raises:
+        ValueError: a value is not in the categories of its column, or is not a valid integer or boolean
+
+    Returns:
+        pd.DataFrame: data with converted columns
+    """
+    categories = categories or {}
+    encoded = {}
+
+    for column in data.columns:
+        values = data[column]
+        is_empty = values.astype("string").fillna("") == ""
+
+        if column in categories:
+            if (unknown := values[~is_empty & ~values.isin(categories[column])]).size:
+                raise ValueError(f"Invalid {column} values, not in config: {sorted(unknown.astype(str).unique())[:10]}")
+            encoded[column] = pd.Categorical(values.mask(is_empty), categories=categories[column])
+        elif column in INTEGER_COLUMNS:
+            encoded[column] = pd.to_numeric(values.astype("string").mask(is_empty)).astype("Int64")
+        elif column in BOOLEAN_COLUMNS:
+            encoded[column] = _to_boolean(values.mask(is_empty))
+        else:
+            encoded[column] = values.astype("string").mask(is_empty)
+
+    return pd.DataFrame(encoded, index=data.index, columns=data.columns)
+
+
+class TableWriter:
+    """Write DataFrames one after the other to a csv, parquet or feather file.
+
+    csv files are written as is. Parquet and feather chunks are converted by encode_table and written as one row
+    group or record batch each, so memory does not grow with the number of rows.
+
+    Args:
+        file (str, path): output file, its format is given by its extension
+        columns (list, optional): columns of the file, written on close if no chunk was written
+        categories (dict, optional): allowed values of categorical columns, see config_categories
+    """
+
+    def __init__(self, file, columns: list = None, categories: dict = None):
+        self.file = Path(file)
+        self.format = TableFormat.from_file(file)
+        self.columns = columns
+        self.categories = categories
+
+        if self.format is not TableFormat.csv:
+            _import_pyarrow()
+
+        self._writer = None
+        self._schema = None
+
+    def write(self, data: pd.DataFrame):
+        if self.format is TableFormat.csv:
+            if self._writer is None:
+                self._writer = open(self.file, "w", newline="")
+                data.to_csv(self._writer, index=False)
+            else:
+                data.to_csv(self._writer, index=False, header=False)
+            return
+
+        pa = _import_pyarrow()
+        data = encode_table(data, self.categories)
+
+        if self._writer is None:
+            self._schema = pa.Schema.from_pandas(data, preserve_index=False)
+            self._writer = self._open(pa)
+
+        self._writer.write_table(pa.Table.from_pandas(data, schema=self._schema, preserve_index=False))
+
+    def _open(self, pa):
+        if self.format is TableFormat.parquet:
+            import pyarrow.parquet as pq
+
+            return pq.ParquetWriter(self.file, self._schema, compression="zstd")
+
+        return pa.ipc.new_file(str(self.file), self._schema, options=pa.ipc.IpcWriteOptions(compression="lz4"))
+
+    def close(self):
+        if self._writer is None and self.columns is not None:
+            # Keep the columns of an empty table
+            self.write(pd.DataFrame({column: pd.Series(dtype="string") for column in self.columns}))
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_table(data: pd.DataFrame, file, categories: dict = None):
+    """Write a DataFrame to a csv, parquet or feather file, see TableWriter."""
+    with TableWriter(file, columns=list(data.columns), categories=categories) as writer:
+        writer.write(data)
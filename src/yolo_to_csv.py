@@ -1,20 +1,155 @@
+from __future__ import annotations
+
 import argparse
 import os
+from functools import partial
+from itertools import islice
 from pathlib import Path
 
 import colorama
-import pandas as pd
-import yaml
 from colorama import Fore
 
-from src.utils import CoordinateMode, cxywh2xyxy, xywh2xyxy
+from src.utils import (
+    CoordinateMode,
+    LabelFormat,
+    bounded_map,
+    cxywh2xyxy_batch,
+    instrument,
+    lazy_import,
+    load_yaml_file,
+    parse_label_files,
+    xywh2xyxy_batch,
+)
+from src.utils.table_io import TableFormat, TableWriter
+
+futures = lazy_import("concurrent.futures")
+Image = lazy_import("PIL.Image")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
 
 colorama.init()
 
+CLASS_ID_COLUMN = "class_id"
+LABEL_SKIP_FILES = {"classes.txt"}  # Class names of yolo datasets, not label files
+
 
 def get_csv_header(config_file: str) -> list:
-    with open(config_file, "r") as file:
-        return yaml.safe_load(file)["yolo_to_csv_header"]
+    return load_yaml_file(config_file)["yolo_to_csv_header"]
+
+
+def _batched(iterable, n: int):
+    """Yield successive lists of at most n items from iterable."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        instrument.count(files=len(batch))
+        yield batch
+
+
+def image_sizes(images: list) -> np.ndarray:
+    """(width, height) of every image, from its header, as stored without EXIF rotation.
+
+    Raises:
+        ValueError: if an image cannot be read
+    """
+    sizes = np.zeros((len(images), 2))
+
+    for i, image in enumerate(images):
+        try:
+            with Image.open(image) as img:
+                sizes[i] = img.size
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ValueError(f"Cannot read the size of {image} to scale its normalized yolo labels: {e}") from e
+
+    return sizes
+
+
+def read_label_files(
+    files: list,
+    mode: CoordinateMode = CoordinateMode.cxywh,
+    csv_header: list = None,
+    label_format: LabelFormat = LabelFormat.named,
+    image_ext: str = ".jpg",
+) -> pd.DataFrame:
+    """Read a batch of YOLO label files into a DataFrame.
+
+    Every line of a label file is one box. For LabelFormat.named the first field is the image name and coordinates
+    are in pixels. For LabelFormat.yolo the first field is the class id, written to the CLASS_ID_COLUMN column if
+    csv_header has one, the image name is the label file name with image_ext, and coordinates are normalized to 0-1:
+    they are scaled by the size of the image next to the label file. Columns of csv_header that yolo labels have no
+    value for, such as lp, are left empty.
+
+    Args:
+        files(list): list of path to label files
+        mode(CoordinateMode): mode of input dataset label coordinate, default to cxywh
+        csv_header(list): list of header for output csv
+        label_format(LabelFormat): layout of the label file, default to named
+        image_ext(str): image extension for LabelFormat.yolo, default to .jpg
+
+    Returns:
+        pd.DataFrame: one row per box, in the given file order
+
+    Raises:
+        ValueError: if the labels do not fit csv_header, or yolo labels are not normalized or have no readable image
+    """
+    fields, file_index = parse_label_files(files)
+    is_yolo = label_format is LabelFormat.yolo
+
+    # Resolve each folder once, not once per file
+    parents = {}
+    paths = np.array([parents.setdefault(f.parent, f.parent.resolve()) for f in files], dtype=object)
+    columns = [paths[file_index]]
+
+    if is_yolo:
+        names = np.array([f.stem + image_ext for f in files], dtype=object)
+        columns.append(names[file_index])
+    else:
+        columns.append(fields[:, 0] if fields.size else fields.reshape(0))
+    attributes = [fields[:, i] for i in range(5, fields.shape[1])]
+
+    # Process coordinate according to its input, all rows in one pass
+    if not fields.size or (mode is CoordinateMode.xyxy and not is_yolo):
+        coordinates = fields[:, 1:5] if fields.size else np.empty((0, 4), dtype=object)
+    else:
+        coordinates = fields[:, 1:5].astype(float)
+        img_size = None
+
+        if is_yolo:
+            rounded = np.round(coordinates, 3)
+            if rounded.min() < 0 or rounded.max() > 1:
+                raise ValueError("yolo label coordinates must be normalized to 0-1, use -f named for pixel labels")
+
+            # Only the images of files with boxes are needed
+            has_boxes = np.bincount(file_index, minlength=len(files)) > 0
+            sizes = np.zeros((len(files), 2))
+            sizes[has_boxes] = image_sizes([files[i].with_name(names[i]) for i in np.flatnonzero(has_boxes)])
+            img_size = sizes[file_index]
+
+        if mode is CoordinateMode.cxywh:
+            coordinates = cxywh2xyxy_batch(coordinates, img_size)
+        elif mode is CoordinateMode.xywh:
+            coordinates = xywh2xyxy_batch(coordinates, img_size)
+        else:
+            coordinates = coordinates * np.tile(img_size, 2)
+
+        coordinates = np.rint(coordinates).astype(int) if is_yolo else coordinates.astype(int)
+
+    columns.extend(coordinates.T)
+    columns.extend(attributes)
+
+    if csv_header is None:
+        csv_header = list(range(len(columns)))
+
+    # The yolo class id is not a license plate, it only fills a column named for it
+    header = [column for column in csv_header if not (is_yolo and column == CLASS_ID_COLUMN)]
+
+    if fields.size and (len(columns) > len(header) if is_yolo else len(columns) != len(header)):
+        raise ValueError(f"Invalid csv header in config, csv_header={csv_header}")
+
+    data = dict(zip(header, columns))
+    if is_yolo and fields.size and CLASS_ID_COLUMN in csv_header:
+        data[CLASS_ID_COLUMN] = fields[:, 0]
+
+    return pd.DataFrame(data, columns=csv_header)
 
 
 def yolo_to_csv(
@@ -22,57 +157,76 @@ def yolo_to_csv(
     output_file: str,
     mode: CoordinateMode = CoordinateMode.cxywh,
     csv_header: list = None,
+    workers: int = 1,
+    chunk_size: int = 10000,
+    label_format: LabelFormat = LabelFormat.named,
+    image_ext: str = ".jpg",
 ):
     """
     Extract metadata from YOLO format dataset into csv.
     The output of coordinate is xyxy where it is top left, and bottom right.
 
+    Label files are read in shards of chunk_size files and each shard is appended to the output file as soon as it is
+    ready, so memory use does not grow with the number of files. With workers > 1 the shards are parsed in a process
+    pool; shards are still written in traversal order, so the output is identical to the serial run.
+
     Args:
         input_folder(str): path to input folder
-        output_file(str): path to output file, must be .csv file
+        output_file(str): path to output file, .csv, .parquet or .feather
         mode(CoordinateMode): mode of input dataset label coordinate, default to cxywh
         csv_header(list): list of header for output csv
+        workers(int): number of worker processes, 1 to run serially
+        chunk_size(int): number of label files per shard
+        label_format(LabelFormat): layout of the label file, default to named
+        image_ext(str): image extension for LabelFormat.yolo, default to .jpg
     """
     if not isinstance(input_folder, Path):
         input_folder = Path(input_folder)
 
-    data = []
-
-    # Traverse the folder structure
-    for file in input_folder.glob("**/*.txt"):
-        # Read the file contents
-        with open(file, "r") as f:
-            content = f.read().strip().split("\t")
+    read_shard = partial(
+        read_label_files,
+        mode=mode,
+        csv_header=csv_header,
+        label_format=label_format,
+        image_ext=image_ext,
+    )
+    label_files = (file for file in input_folder.glob("**/*.txt") if file.name not in LABEL_SKIP_FILES)
+    shards = _batched(label_files, chunk_size)
 
-        # Process coordinate according to its input
-        if mode is not CoordinateMode.xyxy:
-            coordinate = content[1:5]
+    # Keep the header of an empty dataset
+    columns = list(read_label_files([], csv_header=csv_header).columns)
 
-            if mode is CoordinateMode.cxywh:
-                coordinate = cxywh2xyxy(coordinate, True)
-            elif mode is CoordinateMode.xywh:
-                coordinate = xywh2xyxy(coordinate, True)
+    with (
+        instrument.stage("yolo_to_csv"),
+        instrument.Progress(desc=f"Read {input_folder}", unit="rows") as progress,
+        TableWriter(output_file, columns=columns) as writer,
+    ):
+        if workers > 1:
+            with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                _write_shards(writer, bounded_map(executor, read_shard, shards, 2 * workers), progress)
+        else:
+            _write_shards(writer, map(read_shard, shards), progress)
 
-            content[1:5] = coordinate.astype(int).tolist()
 
-        content.insert(0, file.parent.resolve())
-        data.append(content)
+def _write_shards(writer: TableWriter, frames, progress: instrument.Progress = None):
+    """Append DataFrames to the output file, skipping the empty ones."""
+    for df in frames:
+        if len(df):
+            writer.write(df)
 
-    # Save to csv
-    try:
-        df = pd.DataFrame(data, columns=csv_header)
-    except ValueError:
-        raise ValueError(f"Invalid csv header in config, csv_header={csv_header}")
-
-    df.to_csv(output_file, index=False)
+        instrument.count(rows=len(df))
+        if progress is not None:
+            progress.update(len(df))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract metadata from yolo dataset to csv.")
 
     # Add arguments
-    parser.add_argument("-i ", "--input_folder", type=str, help="Input folder path", required=True)
-    parser.add_argument("-o", "--output_file", type=str, help="Output file name (csv)", required=True)
+    parser.add_argument("-i", "--input_folder", type=str, help="Input folder path", required=True)
+    parser.add_argument(
+        "-o", "--output_file", type=str, help="Output file name (csv, parquet or feather)", required=True
+    )
     parser.add_argument(
         "-m",
         "--mode",
@@ -81,6 +235,20 @@ if __name__ == "__main__":
         choices=CoordinateMode.all_option(),
         default=CoordinateMode.default.name,
     )
+    parser.add_argument(
+        "-f",
+        "--label_format",
+        type=str,
+        help="Input label file layout, yolo for standard class id first labels. (default: %(default)s)",
+        choices=LabelFormat.all_option(),
+        default=LabelFormat.default.name,
+    )
+    parser.add_argument(
+        "--image_ext",
+        type=str,
+        help="Image extension for yolo label format. (default: %(default)s)",
+        default=".jpg",
+    )
     parser.add_argument(
         "-c",
         "--config",
@@ -88,25 +256,47 @@ if __name__ == "__main__":
         help="Config file path",
         default="config.yml",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of worker processes for parsing label files. (default: %(default)s)",
+        default=1,
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        help="Number of label files per shard written to the csv. (default: %(default)s)",
+        default=10000,
+    )
+
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
 
-    # Check that output file ends with .csv
-    if not args.output_file.endswith(".csv"):
-        parser.error(Fore.RED + "Output file must end with .csv")
+    # Check that output file is a supported table format
+    try:
+        TableFormat.from_file(args.output_file)
+    except ValueError as e:
+        parser.error(Fore.RED + str(e))
 
     # Check if the input folder exists
     if not os.path.exists(args.input_folder):
         parser.error(Fore.RED + f"Folder {args.input_folder} NOT FOUND")
 
-    try:
-        yolo_to_csv(
-            args.input_folder,
-            args.output_file,
-            mode=CoordinateMode[args.mode],
-            csv_header=get_csv_header(args.config),
-        )
-    except:
-        import traceback
-
-        parser.error(Fore.RED + traceback.format_exc())
+    with instrument.run(args):
+        try:
+            yolo_to_csv(
+                args.input_folder,
+                args.output_file,
+                mode=CoordinateMode[args.mode],
+                csv_header=get_csv_header(args.config),
+                workers=args.workers,
+                chunk_size=args.chunk_size,
+                label_format=LabelFormat[args.label_format],
+                image_ext=args.image_ext,
+            )
+        except:
+            import traceback
+
+            parser.error(Fore.RED + traceback.format_exc())